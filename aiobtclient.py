@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+# Bluetooth client built on asyncio and dbus-next
+#
+# Same events as BTClient without dbus-python, gi nor a GLib main loop.
+# Only the signals sent by bluez are subscribed and the properties of the
+# media transports are cached so that an event is only sent when a value changes.
+# The callback is called in a worker thread, in order, to not block the event loop
+# while the Z906 is answering.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+
+from dbus_next import BusType, Message, MessageType
+from dbus_next.aio import MessageBus
+
+import z906trace
+
+BLUEZ = 'org.bluez'
+MEDIA_TRANSPORT = 'org.bluez.MediaTransport1'
+OBJECT_MANAGER = 'org.freedesktop.DBus.ObjectManager'
+PROPERTIES = 'org.freedesktop.DBus.Properties'
+
+
+class AioBTClient():
+
+    # Cached properties of the media transports and their type
+    properties = { 'State': str, 'Volume': int }
+
+    match_rules = [
+        "type='signal',sender='" + BLUEZ + "',interface='" + OBJECT_MANAGER + "'",
+        "type='signal',sender='" + BLUEZ + "',interface='" + PROPERTIES + "',member='PropertiesChanged',arg0='" + MEDIA_TRANSPORT + "'" ]
+
+    def __init__(self, evtCallback = None, bus_address = None):
+        """
+        bus_address: address of the D-Bus bus to use instead of the system bus
+        """
+        self.bus_address = bus_address
+        self.bus = None
+        self.loop = None
+        # Single worker so that the events are handled in order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="AioBTClient")
+        # Cached properties by transport path
+        self.transports = {}
+        self.callback = evtCallback
+
+        if not self.callback:
+            self.callback = self._dummyCB
+
+        self.logger = logging.getLogger("AioBTClient")
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        if self.bus_address:
+            bus = MessageBus(bus_address=self.bus_address)
+        else:
+            bus = MessageBus(bus_type=BusType.SYSTEM)
+        self.bus = await bus.connect()
+        self.bus.add_message_handler(self._message)
+
+        # Subscribe before listing the transports to not miss any change
+        for rule in self.match_rules:
+            await self._call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'AddMatch', 's', [ rule ])
+
+        await self._loadTransports()
+        self.logger.info("Listening to bluetooth events ...")
+
+    async def _call(self, destination, path, interface, member, signature='', body=[]):
+        reply = await self.bus.call(Message(destination=destination, path=path, interface=interface, member=member, signature=signature, body=body))
+        if reply.message_type == MessageType.ERROR:
+            raise Exception(member + " failed : " + str(reply.error_name) + " " + str(reply.body))
+        return reply.body
+
+    async def _loadTransports(self):
+        try:
+            objects = (await self._call(BLUEZ, '/', OBJECT_MANAGER, 'GetManagedObjects'))[0]
+        except Exception as e:
+            self.logger.warning("Unable to list the existing media transports : " + str(e))
+            return
+
+        for path, interfaces in objects.items():
+            if MEDIA_TRANSPORT in interfaces:
+                self.logger.info("Found existing media transport : " + path)
+                self.transports[path] = self._unpack(interfaces[MEDIA_TRANSPORT])
+
+    def _unpack(self, props):
+        """
+        Convert the variants of the cached properties to their type.
+        """
+        ret = {}
+        for name, prop_type in self.properties.items():
+            if name in props:
+                ret[name] = prop_type(props[name].value)
+        return ret
+
+    def _message(self, msg):
+        if msg.message_type != MessageType.SIGNAL:
+            return
+
+        if msg.interface == PROPERTIES and msg.member == 'PropertiesChanged':
+            interface, changed, invalidated = msg.body
+            if interface != MEDIA_TRANSPORT:
+                return
+            with z906trace.begin("bt_signal", path=msg.path):
+                self._transportChanged(msg.path, self._unpack(changed))
+
+        elif msg.interface == OBJECT_MANAGER and msg.member == 'InterfacesAdded':
+            path, interfaces = msg.body
+            if MEDIA_TRANSPORT not in interfaces:
+                return
+            self.logger.info("Found new media transport : " + path)
+            self.transports[path] = self._unpack(interfaces[MEDIA_TRANSPORT])
+
+        elif msg.interface == OBJECT_MANAGER and msg.member == 'InterfacesRemoved':
+            path, interfaces = msg.body
+            if MEDIA_TRANSPORT not in interfaces:
+                return
+            self.logger.info("Media transport gone : " + path)
+            self.transports.pop(path, None)
+
+    def _transportChanged(self, path, changed):
+        cache = self.transports.get(path)
+        if cache is None:
+            self.logger.info("Found existing media transport : " + path)
+            cache = self.transports[path] = {}
+
+        # Only keep the values which actually changed
+        changed = { name: val for name, val in changed.items() if cache.get(name) != val }
+        cache.update(changed)
+
+        if 'State' in changed:
+            if changed['State'] == 'pending':
+                self.logger.info("Playback started")
+                self._dispatch("play")
+            elif changed['State'] == 'idle':
+                self.logger.info("Playback stopped")
+                self._dispatch("pause")
+
+        if 'Volume' in changed:
+            vol = changed['Volume']
+            self.logger.info("New volume : " + str(vol))
+            self._dispatch("volume", vol)
+
+    def _dispatch(self, *args):
+        """
+        Call the callback in the worker thread, keeping the trace correlation id.
+        """
+        ctx = contextvars.copy_context()
+        future = self.loop.run_in_executor(self.executor, ctx.run, self.callback, *args)
+        future.add_done_callback(self._dispatched)
+
+    def _dispatched(self, future):
+        if not future.cancelled() and future.exception():
+            self.logger.error("Error while handling the event : " + repr(future.exception()))
+
+    async def run(self):
+        await self.connect()
+        await self.bus.wait_for_disconnect()
+
+    def mainloop(self):
+        asyncio.run(self.run())
+
+    def _dummyCB(self, evt, val = None):
+        if val:
+            self.logger.debug("Event : " + evt + " (" + str(val) + ")")
+        else:
+            self.logger.debug("Event : " + evt)
+
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    client = AioBTClient()
+    client.mainloop()
@@ -1,20 +1,24 @@
 #!/usr/bin/python3
 
-import dbus
-import dbus.mainloop.glib
 import logging
 
-import gi
-gi.require_version('Gst', '1.0')
-from gi.repository import GLib
-
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+import z906trace
 
 
 class BTClient():
     
-    def __init__(self, evtCallback = None):
-        self.bus = dbus.SystemBus()
+    def __init__(self, evtCallback = None, bus = None):
+        """
+        bus: D-Bus connection to use instead of the system bus
+        """
+        if bus is None:
+            import dbus
+            import dbus.mainloop.glib
+
+            # The main loop must be set before connecting to the bus to receive signals
+            dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+            bus = dbus.SystemBus()
+        self.bus = bus
         self.transports = {}
         self.callback = evtCallback
 
@@ -30,23 +34,29 @@ class BTClient():
 
         self.logger.info("Listening to bluetooth events ...")
 
-    def _interfaceAdded(self, path, interface):
-        if interface != 'org.bluez.MediaTransport1':
+    def _interfaceAdded(self, path, interfaces):
+        # interfaces is a dict of interface names and their properties
+        if 'org.bluez.MediaTransport1' not in interfaces:
             return
 
         self.logger.info("Found new media transport : " + path)
         self.transports[path] = { 'volume': 0 }
 
-    def _interfaceRemoved(self, path, interface):
-        if interface != ' org.bluez.MediaTransport1':
+    def _interfaceRemoved(self, path, interfaces):
+        # interfaces is a list of interface names
+        if 'org.bluez.MediaTransport1' not in interfaces:
             return 
 
         self.logger.info("Media transport gone : " + path)
-        del self.transports[path]
+        self.transports.pop(path, None)
 
     def _propertiesChanged(self, interface, changed, invalidated, path):
         if interface != 'org.bluez.MediaTransport1':
             return
+        with z906trace.begin("bt_signal", path=str(path)):
+            self._transportChanged(changed, path)
+
+    def _transportChanged(self, changed, path):
         if path not in self.transports:
             self.logger.info("Found existing media transport : " + path)
             self.transports[path] = { 'volume': 0}
@@ -67,7 +77,7 @@ class BTClient():
 
     def mainloop(self):
 
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        from gi.repository import GLib
         mainloop = GLib.MainLoop()
         mainloop.run()
         return
@@ -1,37 +1,41 @@
 #! /usr/bin/python3
 
-import cec
 import logging
 import time
-import argparse
 
-argparser = argparse.ArgumentParser(description="CEC client")
-argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+import z906trace
 
 class CecClient:
 
-    cecconfig = cec.libcec_configuration()
+    cecconfig = None
     lib = None
     evtCallback = None
     enabled = True
+    recorder = None
 
     src_port = None
+    audio_status = None
 
-    def __init__(self, name):
-        self.cecconfig.strDeviceName = name
-        self.cecconfig.bActivateSource = 0
-        self.cecconfig.deviceTypes.Add(cec.CEC_DEVICE_TYPE_AUDIO_SYSTEM)
-        self.cecconfig.clientVersion = cec.LIBCEC_VERSION_CURRENT
-        self.cecconfig.SetLogCallback(self._cecLogCallback)
-        try:
-            self.cecconfig.SetCommandHandlerCallback(self._cmdCallback)
-        except:
-            print("This client requires a patched version of libcec. The official version doesn't allow the implementation of this features.")
-            print("See https://github.com/Pulse-Eight/libcec/pull/617\n\n")
-            raise Exception("Unsupported libcec")
-
+    # Volume steps of each key press event according to the number of repeats while the key is held
+    volume_curve = (1, 1, 1, 2, 2, 3, 4)
+    # Maximum delay between the repeats of a held key, a key not repeated in time is considered released
+    key_repeat_timeout = 0.6
 
+    def __init__(self, name, volume_curve=None):
+        self.name = name
         self.evtCallback = self._dummyCecCallback
+        if volume_curve:
+            self.volume_curve = tuple(volume_curve)
+
+        # Key currently held, number of repeats and time of the last press
+        self.held_key = None
+        self.held_repeats = 0
+        self.held_time = 0.0
+
+        # Replies to the TV queries : data by opcode and the commands built from it by (opcode, destination),
+        # replaced together so that a command built from old data is never cached with the new one
+        self.replies = ({}, {})
+        self._updateReplies()
 
         self.logger = logging.getLogger("CecClient")
 
@@ -43,7 +47,24 @@ class CecClient:
 
 
     def open(self):
+        import cec
+
+        self.cecconfig = cec.libcec_configuration()
+        self.cecconfig.strDeviceName = self.name
+        self.cecconfig.bActivateSource = 0
+        self.cecconfig.deviceTypes.Add(cec.CEC_DEVICE_TYPE_AUDIO_SYSTEM)
+        self.cecconfig.clientVersion = cec.LIBCEC_VERSION_CURRENT
+        self.cecconfig.SetLogCallback(self._cecLogCallback)
+        try:
+            self.cecconfig.SetCommandHandlerCallback(self._cmdCallback)
+        except:
+            print("This client requires a patched version of libcec. The official version doesn't allow the implementation of this features.")
+            print("See https://github.com/Pulse-Eight/libcec/pull/617\n\n")
+            raise Exception("Unsupported libcec")
+
         self.lib = cec.ICECAdapter.Create(self.cecconfig)
+        # Rebuild the cached replies with the library
+        self._updateReplies(rebuild=True)
         self.logger.info("libCEC version " + self.lib.VersionToString(self.cecconfig.serverVersion) + " loaded: " + self.lib.GetLibInfo())
 
         #search for adapters
@@ -56,19 +77,71 @@ class CecClient:
         self.lib.Open(adapter.strComName)
 
 
-    def reportAudioStatus(self, level, mute):
-
+    def _updateReplies(self, rebuild=False):
+        """
+        Update the replies to the TV queries after a state change.
+        The commands are built on demand, the ones built from data which didn't change are kept.
+        rebuild: forget all the built commands
+        """
+        reply_data = {}
+        if self.audio_status is not None:
+            # Give audio status
+            reply_data['71'] = "7a:{:02x}".format(self.audio_status)
+        if self.enabled:
+            reply_data['7d'] = "7e:01" # System audio mode on
+            reply_data['8f'] = "90:00" # Power on
+            reply_data['70'] = "72:01" # System audio mode on
+        else:
+            reply_data['7d'] = "7e:00" # System audio mode off
+            reply_data['8f'] = "90:01" # Standby
+            reply_data['70'] = "72:00" # System audio mode off
+
+        old_data, old_cmds = self.replies
+        cmds = {}
+        if not rebuild:
+            # Copied first, the command handler may add commands meanwhile
+            cmds = { key: cmd for key, cmd in list(old_cmds.items()) if reply_data.get(key[0]) == old_data.get(key[0]) }
+        self.replies = (reply_data, cmds)
+
+    def _sendReply(self, opcode, dst):
+        """
+        Send the cached reply to a query.
+        Return False if there is no reply for this query.
+        """
+        reply_data, cmds = self.replies
+        key = (opcode, dst)
+        cmd = cmds.get(key)
+        if cmd is None:
+            data = reply_data.get(opcode)
+            if data is None:
+                return False
+            cmd = self._buildCommand(data, dst=dst)
+            cmds[key] = cmd
+        self._transmit(cmd)
+        return True
+
+    def setAudioStatus(self, level, mute):
+        """
+        Update the audio status reported to the TV when it asks for it.
+        """
         status = int(level)
         if mute:
             status += 0x80
-        cmd = "7A:{:02x}".format(status)
-        self.sendCommand(cmd)
+        if status != self.audio_status:
+            self.audio_status = status
+            self._updateReplies()
+
+    def reportAudioStatus(self, level, mute):
+
+        self.setAudioStatus(level, mute)
+        self._sendReply('71', '0')
 
     def enable(self):
         if self.enabled:
             return
 
         self.enabled = True
+        self._updateReplies()
         self.logger.info("Enabling CEC ARC")
 
 
@@ -83,6 +156,7 @@ class CecClient:
             return
 
         self.enabled = False
+        self._updateReplies()
         self.logger.info("Disabling CEC ARC")
 
         # Power off
@@ -100,17 +174,52 @@ class CecClient:
 
     def _cmdCallback(self, cmd):
 
+        if self.recorder:
+            self.recorder.record("CEC", cmd)
+
+        with z906trace.begin("cec_command", cmd=cmd):
+            return self._handleCommand(cmd)
+
+    def _event(self, evt, val=None):
+        with z906trace.span("event", evt=evt):
+            if val is None:
+                self.evtCallback(evt)
+            else:
+                self.evtCallback(evt, val)
+
+    def _keyPressed(self, key):
+        """
+        Track a key press and return the number of volume steps for it.
+        The TV repeats the key press while the key is held and sends a release at the end.
+        """
+        now = time.monotonic()
+        if key == self.held_key and now - self.held_time < self.key_repeat_timeout:
+            self.held_repeats += 1
+        else:
+            self.held_key = key
+            self.held_repeats = 0
+        self.held_time = now
+        return self.volume_curve[min(self.held_repeats, len(self.volume_curve) - 1)]
+
+    def _handleCommand(self, cmd):
+
         cmd=cmd[3:]
+        if len(cmd) < 5:
+            self.logger.debug("Ignoring truncated command")
+            return 0
+
+        return self._handleMessage(cmd[0], cmd[1], cmd[3:])
+
+    def _handleMessage(self, src, dst, cmd):
+        """
+        Handle a message from src to dst, cmd is the opcode and the parameters as hex bytes separated by ':'.
+        """
 
         # Discard source and dest
-        if cmd[1] != 'f' and cmd[1] != '5':
+        if dst != 'f' and dst != '5':
             self.logger.debug("Ignoring command as it's not destined for broadcast or audio-system")
             return 0
 
-        src = cmd[0]
-        dst = cmd[1]
-        cmd = cmd[3:]
-
         if cmd.startswith('87:'):
             # Ignore Vendor ID command which are sent at regular interval
             return 1
@@ -122,19 +231,24 @@ class CecClient:
             # Parse key press
             key = cmd[3:]
             if key == '41':
-                self.logger.debug("Received key : Volume up")
-                self.evtCallback("level_up")
+                steps = self._keyPressed(key)
+                self.logger.debug("Received key : Volume up (" + str(steps) + " steps)")
+                self._event("level_up", steps)
             elif key == '42':
-                self.logger.debug("Received key : Volume down")
-                self.evtCallback("level_down")
+                steps = self._keyPressed(key)
+                self.logger.debug("Received key : Volume down (" + str(steps) + " steps)")
+                self._event("level_down", steps)
             elif key == '43':
+                self.held_key = None
                 self.logger.debug("Received key : Mute")
-                self.evtCallback("mute")
+                self._event("mute")
             else:
+                self.held_key = None
                 return 1
 
         # Key press released
         elif cmd == "45":
+            self.held_key = None
             self.logger.debug("Key released")
 
         # Vendor ID
@@ -144,12 +258,12 @@ class CecClient:
         # ARC initiated
         elif cmd == "c1":
             self.logger.debug("Received: ARC initiated")
-            self.evtCallback("arc_start")
+            self._event("arc_start")
 
         # ARC terminated
         elif cmd == "c2":
             self.logger.debug("Recived: ARC terminated")
-            self.evtCallback("arc_stop")
+            self._event("arc_stop")
 
         # ARC start
         elif cmd == "c3":
@@ -166,17 +280,19 @@ class CecClient:
         elif cmd == "36":
             # Standby
             self.logger.debug("Received : TV Standby")
-            self.evtCallback("standby")
+            self._event("standby")
 
         # Get CEC Version
         elif cmd == "9f":
             self.logger.debug("Received : Get CEC Version")
-            self.send("9e:05", dst=src) # Version 1.4
+            self.sendCommand("9e:05", dst=src) # Version 1.4
 
         # Give audio status
         elif cmd == "71":
             self.logger.debug("Received : Give audio status")
-            self.evtCallback("give_audio_status")
+            if not self._sendReply('71', src):
+                # Audio status not known yet
+                self._event("give_audio_status")
 
         # Abort vendor commands
         elif cmd == "89":
@@ -185,46 +301,31 @@ class CecClient:
 
         # Give system audio mode status
         elif cmd == "7d":
-            if self.enabled:
-                # Audio status on
-                self.sendCommand("7e:01", dst=src)
-            else:
-                # Audio status off
-                self.sendCommand("7e:00", dst=src)
+            self._sendReply('7d', src)
 
         # Give power status
         elif cmd == "8f":
-            if self.enabled:
-                # Power on
-                self.sendCommand("90:00", dst=src)
-            else:
-                # Standby
-                self.sendCommand("90:01", dst=src)
-
+            self._sendReply('8f', src)
 
         # System audio mode request
         elif cmd.startswith("70"):
-
-            if self.enabled:
-                self.sendCommand("72:01", dst=src)
-            else:
-                self.sendCommand("72:00", dst=src)
+            self._sendReply('70', src)
 
         # One touch play active source
-        elif cmd.startswith("82:"):
+        elif cmd.startswith("82:") and len(cmd) >= 8:
             src_port = cmd[3] + '.' + cmd[4] + '.' + cmd[6] + '.' + cmd[7]
             self.logger.debug("Received one touch play on HDMI port " + src_port)
             if src_port != self.src_port:
                 self.src_port = src_port
-                self.evtCallback("src_changed")
+                self._event("src_changed")
 
         # Routing change
-        elif cmd.startswith("80:"):
+        elif cmd.startswith("80:") and len(cmd) >= 14:
             src_port = cmd[9] + '.' + cmd[10] + '.' + cmd[12] + '.' + cmd[13]
             self.logger.debug("Received routing change to new address " + src_port)
             if src_port != self.src_port:
                 self.src_port = src_port
-                self.evtCallback("src_changed")
+                self._event("src_changed")
 
         # Vendor specific command
         elif cmd.startswith("a0:"):
@@ -240,36 +341,62 @@ class CecClient:
         self.logger.debug("Command " + cmd + " handled")
         return 1
 
-    def sendCommand(self, data, src='5', dst='0'):
+    def _buildCommand(self, data, src='5', dst='0'):
+        """
+        Build a command ready to be transmitted.
+        """
         cmd_str = src + dst + ':' + data
+        if not self.lib:
+            return (cmd_str, None)
+        return (cmd_str, self.lib.CommandFromString(cmd_str))
+
+    def _transmit(self, cmd):
+        cmd_str, cec_cmd = cmd
         self.logger.debug("Sending command : " + cmd_str)
-        cmd = self.lib.CommandFromString(cmd_str)
-        if not self.lib.Transmit(cmd):
-            self.logger.warning("Error while sending CEC command")
-#        else:
-#            self.logger.debug("Sent : " + cmd_str)
+        if self.recorder:
+            self.recorder.record("CECTX", cmd_str)
+        if not cec_cmd:
+            self.logger.debug("CEC adapter not opened, command dropped")
+            return
+        with z906trace.span("cec_transmit", cmd=cmd_str):
+            if not self.lib.Transmit(cec_cmd):
+                self.logger.warning("Error while sending CEC command")
+
+    def sendCommand(self, data, src='5', dst='0'):
+        self._transmit(self._buildCommand(data, src, dst))
 
 
     def setEventCallback(self, callback):
         self.evtCallback = callback
 
 
-    def _dummyCecCallback(self, evt):
-        self.logger.debug("Got event " + evt)
+    def _dummyCecCallback(self, evt, val=None):
+        if val is not None:
+            self.logger.debug("Got event " + evt + " (" + str(val) + ")")
+        else:
+            self.logger.debug("Got event " + evt)
         if evt == "give_audio_status":
             # Report dummy status
             self.reportAudioStatus(10, False)
 
-if __name__ == '__main__':
-
-    cecClient = CecClient("Z906")
-    cecClient.open()
+def main(argv=None):
 
-    args = argparser.parse_args()
+    import argparse
+    argparser = argparse.ArgumentParser(description="CEC client")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    args = argparser.parse_args(argv)
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
+
+    cecClient = CecClient("Z906")
+    cecClient.open()
+
     while True:
         time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#! /usr/bin/python3
+
+# CEC client using the Linux kernel CEC framework (/dev/cecN)
+#
+# It doesn't need libcec : the Audio System logical address is claimed with the
+# CEC ioctls and the received messages are handled by the same code as CecClient.
+# The replies are cached as ready to transmit cec_msg structures.
+
+import errno
+import fcntl
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import cecclient
+import z906trace
+
+
+def _ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('a') << 8) | nr
+
+_IOC_WRITE  = 1
+_IOC_READ   = 2
+
+# struct cec_msg
+MSG = struct.Struct('<QQIIII16sBBBBBBBx')
+MSG_MAX_LENGTH = 16
+MSG_LEN_OFFSET = 16
+MSG_TIMEOUT_OFFSET = 20
+MSG_DATA_OFFSET = 32
+MSG_TX_STATUS_OFFSET = 50
+
+# struct cec_log_addrs
+LOG_ADDRS = struct.Struct('<4sHBBII15s4s4s4s48sx')
+
+CEC_ADAP_G_PHYS_ADDR    = _ioc(_IOC_READ, 1, 2)
+CEC_ADAP_S_LOG_ADDRS    = _ioc(_IOC_READ | _IOC_WRITE, 4, LOG_ADDRS.size)
+CEC_TRANSMIT            = _ioc(_IOC_READ | _IOC_WRITE, 5, MSG.size)
+CEC_RECEIVE             = _ioc(_IOC_READ | _IOC_WRITE, 6, MSG.size)
+CEC_S_MODE              = _ioc(_IOC_WRITE, 9, 4)
+
+CEC_MODE_EXCL_INITIATOR = 0x02
+CEC_MODE_EXCL_FOLLOWER  = 0x20
+
+CEC_OP_CEC_VERSION_1_4          = 5
+CEC_LOG_ADDR_TYPE_AUDIOSYSTEM   = 4
+CEC_OP_PRIM_DEVTYPE_AUDIOSYSTEM = 5
+CEC_OP_ALL_DEVTYPE_AUDIOSYSTEM  = 0x08
+CEC_VENDOR_ID_NONE              = 0xffffffff
+CEC_LOG_ADDR_INVALID            = 0xff
+
+CEC_TX_STATUS_OK                = 0x01
+
+CEC_PHYS_ADDR_INVALID           = 0xffff
+
+DEVICE = '/dev/cec0'
+
+
+class KernelCecClient(cecclient.CecClient):
+
+    fd = None
+    # Timeout of the receive ioctl in ms, bounds the time needed to close the client
+    receive_timeout = 500
+
+    def __init__(self, name, device=DEVICE, volume_curve=None):
+        cecclient.CecClient.__init__(self, name, volume_curve)
+        self.device = device
+        self.logical_address = None
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger("KernelCecClient")
+
+    def open(self):
+        """
+        Open the device and claim the audio system logical address.
+        When the physical address isn't known yet (TV off or unplugged), the kernel
+        claims the logical address later and the device is kept open.
+        Return False if the logical address can't be claimed.
+        """
+        self.fd = os.open(self.device, os.O_RDWR)
+        try:
+            # Handle all the messages which are not processed by the kernel
+            fcntl.ioctl(self.fd, CEC_S_MODE, struct.pack('<I', CEC_MODE_EXCL_INITIATOR | CEC_MODE_EXCL_FOLLOWER))
+
+            phys_addr = struct.unpack('<H', fcntl.ioctl(self.fd, CEC_ADAP_G_PHYS_ADDR, bytes(2)))[0]
+
+            # Remove any previous logical address, then claim the audio system one
+            fcntl.ioctl(self.fd, CEC_ADAP_S_LOG_ADDRS, bytes(LOG_ADDRS.size))
+            log_addrs = bytearray(LOG_ADDRS.pack(b'', 0, CEC_OP_CEC_VERSION_1_4, 1, CEC_VENDOR_ID_NONE, 0, self.name.encode()[:14],
+                    bytes((CEC_OP_PRIM_DEVTYPE_AUDIOSYSTEM,)), bytes((CEC_LOG_ADDR_TYPE_AUDIOSYSTEM,)), bytes((CEC_OP_ALL_DEVTYPE_AUDIOSYSTEM,)), b''))
+            fcntl.ioctl(self.fd, CEC_ADAP_S_LOG_ADDRS, log_addrs, True)
+        except OSError:
+            self.close()
+            raise
+
+        log_addr = LOG_ADDRS.unpack(log_addrs)[0][0]
+        phys_str = "{:x}.{:x}.{:x}.{:x}".format(*((phys_addr >> s) & 0xf for s in (12, 8, 4, 0)))
+        if log_addr != CEC_LOG_ADDR_INVALID:
+            self.logical_address = log_addr
+            self.logger.info("Opened " + self.device + " with logical address " + str(log_addr) + " and physical address " + phys_str)
+        elif phys_addr == CEC_PHYS_ADDR_INVALID:
+            # Not configured yet, the kernel claims the logical address once the physical address is set
+            self.logger.warning("Physical address not set, is the HDMI cable connected ? Waiting for the TV")
+            self.logger.info("Opened " + self.device + " without logical address")
+        else:
+            self.logger.critical("Unable to claim the audio system logical address")
+            self.close()
+            return False
+
+        # Rebuild the cached replies with the device
+        self._updateReplies(rebuild=True)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._receiveLoop, name="KernelCecClient", daemon=True)
+        self.thread.start()
+        return True
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _receiveLoop(self):
+        buf = bytearray(MSG.size)
+        while self.running:
+            struct.pack_into('<II', buf, MSG_LEN_OFFSET, 0, self.receive_timeout)
+            try:
+                fcntl.ioctl(self.fd, CEC_RECEIVE, buf, True)
+            except OSError as e:
+                if e.errno == errno.ETIMEDOUT:
+                    continue
+                self.logger.error("Error while receiving a CEC message : " + str(e))
+                time.sleep(1)
+                continue
+
+            length = buf[MSG_LEN_OFFSET]
+            try:
+                self._msgCallback(bytes(buf[MSG_DATA_OFFSET:MSG_DATA_OFFSET + length]))
+            except Exception:
+                self.logger.exception("Error while handling a CEC message")
+
+    def _msgCallback(self, msg):
+        """
+        Handle a raw CEC message, the first byte is the initiator and destination.
+        """
+        if len(msg) < 2:
+            # Poll message
+            return 0
+
+        cmd = msg[1:].hex(':')
+        if self.recorder:
+            self.recorder.record("CEC", ">> {:02x}:".format(msg[0]) + cmd)
+
+        with z906trace.begin("cec_command", cmd=cmd):
+            return self._handleMessage("{:x}".format(msg[0] >> 4), "{:x}".format(msg[0] & 0xf), cmd)
+
+    def _buildCommand(self, data, src='5', dst='0'):
+        """
+        Build a command ready to be transmitted as a cec_msg structure.
+        """
+        cmd_str = src + dst + ':' + data
+        if self.fd is None:
+            return (cmd_str, None)
+        msg = bytes(((int(src, 16) << 4) | int(dst, 16),)) + bytes.fromhex(data.replace(':', ''))
+        return (cmd_str, MSG.pack(0, 0, len(msg), 0, 0, 0, msg, 0, 0, 0, 0, 0, 0, 0))
+
+    def _transmit(self, cmd):
+        cmd_str, cec_cmd = cmd
+        self.logger.debug("Sending command : " + cmd_str)
+        if self.recorder:
+            self.recorder.record("CECTX", cmd_str)
+        if not cec_cmd:
+            self.logger.debug("CEC device not opened, command dropped")
+            return
+        with z906trace.span("cec_transmit", cmd=cmd_str):
+            try:
+                ret = fcntl.ioctl(self.fd, CEC_TRANSMIT, cec_cmd)
+            except OSError as e:
+                self.logger.warning("Error while sending CEC command : " + str(e))
+                return
+            if not ret[MSG_TX_STATUS_OFFSET] & CEC_TX_STATUS_OK:
+                self.logger.warning("Error while sending CEC command, status {:02x}".format(ret[MSG_TX_STATUS_OFFSET]))
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Kernel CEC client")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--device', '-D', dest='device', help='CEC device', default=DEVICE)
+    args = argparser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    cecClient = KernelCecClient("Z906", args.device)
+    if not cecClient.open():
+        return 1
+
+    while True:
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#! /usr/bin/python3
+
+# Microbenchmarks of the frame codec compared to the previous list based implementation.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import z906frame
+
+STATUS_FRAME = bytes(z906frame.build(0x0A, range(20)))
+
+
+def legacy_cksum(data):
+    cksum = 0
+    for b in data[1:-1]:
+        cksum += b
+    return 0x100 - (cksum & 0xFF)
+
+
+def legacy_build(req_type, data):
+    req = [ 0xAA, req_type, len(data) ]
+    req.extend(data)
+    req.append(0x0)
+    req[-1] = legacy_cksum(req)
+    return bytes(req)
+
+
+def legacy_parse(frame):
+    ret = bytearray(frame[0:1])
+    ret.extend(bytearray(frame[1:3]))
+    ret.extend(bytearray(frame[3:3 + ret[2] + 1]))
+    return legacy_cksum(ret) == ret[-1]
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 frame codec benchmark")
+    argparser.add_argument('--count', '-n', dest='count', help='Number of iterations', default=200000, type=int)
+    args = argparser.parse_args(argv)
+
+    buf = bytearray(z906frame.frame_length(z906frame.MAX_DATA_LENGTH))
+    data = bytes(range(20))
+
+    benchmarks = {
+        'legacy build': lambda: legacy_build(0x0A, data),
+        'build': lambda: z906frame.build(0x0A, data),
+        'build (preallocated)': lambda: z906frame.build(0x0A, data, buf),
+        'legacy parse+cksum': lambda: legacy_parse(STATUS_FRAME),
+        'is_valid': lambda: z906frame.is_valid(STATUS_FRAME),
+        }
+
+    for name, fn in benchmarks.items():
+        t = min(timeit.repeat(fn, number=args.count, repeat=3))
+        print("{:<24} {:8.1f} ns/frame, {:10.0f} frames/s".format(name, t / args.count * 1e9, args.count / t))
+
+
+if __name__ == '__main__':
+    main()
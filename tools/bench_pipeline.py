@@ -0,0 +1,53 @@
+#! /usr/bin/python3
+
+# Throughput of the pipelined transport for several window sizes against the simulator.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import z906client
+import z906sim
+
+# 11 bits per byte at 57600 bauds
+BYTE_TIME = 11.0 / 57600
+
+
+def run(cmds, window, latency, legacy=False):
+    sim = z906sim.Z906Simulator(latency=latency, byte_time=BYTE_TIME)
+    z906 = z906client.Z906Client(ser=sim)
+    start = time.perf_counter()
+    if legacy:
+        for cmd in cmds:
+            z906.request(cmd)
+    else:
+        z906.request_many(cmds, window)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 pipelining benchmark")
+    argparser.add_argument('--count', '-n', dest='count', help='Number of commands', default=200, type=int)
+    argparser.add_argument('--latency', '-l', dest='latency', help='Simulated response latency in ms', default=2.0, type=float)
+    argparser.add_argument('--legacy', dest='legacy', help='Also benchmark the stop-and-wait request()', default=False, action='store_const', const=True)
+    args = argparser.parse_args(argv)
+
+    # Volume up and down so the level stays within bounds
+    cmds = [ 0x08, 0x09 ] * (args.count // 2)
+    latency = args.latency / 1000
+
+    if args.legacy:
+        t = run(cmds, 1, latency, True)
+        print("{:<12} {:8.1f} cmds/s".format("request()", len(cmds) / t))
+
+    for window in (1, 2, 4, 8, 16):
+        t = run(cmds, window, latency)
+        print("{:<12} {:8.1f} cmds/s".format("window " + str(window), len(cmds) / t))
+
+
+if __name__ == '__main__':
+    main()
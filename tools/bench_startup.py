@@ -0,0 +1,52 @@
+#! /usr/bin/python3
+
+# Measure the cold start latency of the modules and of the CLI.
+# Each measurement spawns a fresh interpreter so nothing is cached between runs.
+
+import os
+import subprocess
+import sys
+import time
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BENCHMARKS = {
+    'import z906client': [ '-c', 'import z906client' ],
+    'import z906cec': [ '-c', 'import z906cec' ],
+    'import z906bt': [ '-c', 'import z906bt' ],
+    'z906client.py --help': [ os.path.join(TOP_DIR, 'z906client.py'), '--help' ],
+    }
+
+
+def run(args, count):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        ret = subprocess.run([ sys.executable ] + args, cwd=TOP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+        if ret.returncode != 0:
+            return None
+    timings.sort()
+    return timings
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 startup benchmark")
+    argparser.add_argument('--count', '-n', dest='count', help='Number of runs per benchmark', default=20, type=int)
+    args = argparser.parse_args(argv)
+
+    baseline = run([ '-c', 'pass' ], args.count)
+    print("{:<24} min {:7.2f} ms, median {:7.2f} ms".format("interpreter", baseline[0] * 1000, baseline[len(baseline) // 2] * 1000))
+
+    for name, bench_args in BENCHMARKS.items():
+        timings = run(bench_args, args.count)
+        if not timings:
+            print("{:<24} failed (missing dependency ?)".format(name))
+            continue
+        print("{:<24} min {:7.2f} ms, median {:7.2f} ms (+{:.2f} ms over interpreter)".format(name, timings[0] * 1000, timings[len(timings) // 2] * 1000, (timings[0] - baseline[0]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
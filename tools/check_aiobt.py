@@ -0,0 +1,161 @@
+#! /usr/bin/python3
+
+# Test of the asyncio Bluetooth client against a fake bluez
+#
+# A private D-Bus daemon is started and a fake org.bluez service exports an
+# object manager and a MediaTransport1 object. The transport is added, played,
+# its volume changed and removed while checking the events of AioBTClient.
+# Requires dbus-next and dbus-daemon.
+
+import asyncio
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dbus_next import PropertyAccess, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, dbus_property, method, signal
+
+import aiobtclient
+
+TRANSPORT_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55/sep1/fd0'
+
+
+class FakeObjectManager(ServiceInterface):
+
+    def __init__(self):
+        super().__init__(aiobtclient.OBJECT_MANAGER)
+        self.objects = {}
+
+    @method()
+    def GetManagedObjects(self) -> 'a{oa{sa{sv}}}':
+        return self.objects
+
+    @signal()
+    def InterfacesAdded(self, path, interfaces) -> 'oa{sa{sv}}':
+        return [ path, interfaces ]
+
+    @signal()
+    def InterfacesRemoved(self, path, interfaces) -> 'oas':
+        return [ path, interfaces ]
+
+
+class FakeTransport(ServiceInterface):
+
+    def __init__(self):
+        super().__init__(aiobtclient.MEDIA_TRANSPORT)
+        self.state = 'idle'
+        self.volume = 64
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> 's':
+        return self.state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Volume(self) -> 'q':
+        return self.volume
+
+    def set(self, state=None, volume=None):
+        changed = {}
+        if state is not None:
+            self.state = changed['State'] = state
+        if volume is not None:
+            self.volume = changed['Volume'] = volume
+        self.emit_properties_changed(changed)
+
+    def props(self):
+        return { 'State': Variant('s', self.state), 'Volume': Variant('q', self.volume) }
+
+
+async def wait_events(events, count, timeout=2.0):
+    for i in range(int(timeout / 0.01)):
+        if len(events) >= count:
+            return
+        await asyncio.sleep(0.01)
+
+
+async def run(address):
+    bluez = await MessageBus(bus_address=address).connect()
+    manager = FakeObjectManager()
+    bluez.export('/', manager)
+    await bluez.request_name(aiobtclient.BLUEZ)
+
+    events = []
+    client = aiobtclient.AioBTClient(lambda evt, val=None: events.append((evt, val)), bus_address=address)
+    await client.connect()
+
+    failures = []
+    def check(what, expected):
+        if events != expected:
+            failures.append(what + " : expected " + str(expected) + ", got " + str(events))
+        events.clear()
+
+    transport = FakeTransport()
+    bluez.export(TRANSPORT_PATH, transport)
+    manager.objects[TRANSPORT_PATH] = { aiobtclient.MEDIA_TRANSPORT: transport.props() }
+    manager.InterfacesAdded(TRANSPORT_PATH, { aiobtclient.MEDIA_TRANSPORT: transport.props() })
+    await wait_events(events, 1, 0.2)
+    check("transport added", [])
+    if TRANSPORT_PATH not in client.transports:
+        failures.append("transport not tracked")
+
+    transport.set(state='pending')
+    await wait_events(events, 1)
+    check("play", [ ('play', None) ])
+
+    transport.set(volume=100)
+    await wait_events(events, 1)
+    check("volume", [ ('volume', 100) ])
+
+    # Unchanged values must not be reported again
+    transport.set(state='pending', volume=100)
+    await wait_events(events, 1, 0.2)
+    check("unchanged", [])
+
+    # Signals from other senders are not subscribed
+    other = await MessageBus(bus_address=address).connect()
+    other_transport = FakeTransport()
+    other.export(TRANSPORT_PATH, other_transport)
+    other_transport.set(state='idle')
+    await wait_events(events, 1, 0.2)
+    check("other sender", [])
+
+    transport.set(state='idle')
+    await wait_events(events, 1)
+    check("pause", [ ('pause', None) ])
+
+    del manager.objects[TRANSPORT_PATH]
+    manager.InterfacesRemoved(TRANSPORT_PATH, [ aiobtclient.MEDIA_TRANSPORT ])
+    for i in range(100):
+        if TRANSPORT_PATH not in client.transports:
+            break
+        await asyncio.sleep(0.01)
+    else:
+        failures.append("transport not removed")
+
+    client.bus.disconnect()
+    other.disconnect()
+    bluez.disconnect()
+    return failures
+
+
+def main():
+    daemon = subprocess.Popen([ 'dbus-daemon', '--session', '--nofork', '--print-address' ], stdout=subprocess.PIPE, text=True)
+    try:
+        address = daemon.stdout.readline().strip()
+        failures = asyncio.run(run(address))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    for f in failures:
+        print("FAILED : " + f)
+    if failures:
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == '__main__':
+    main()
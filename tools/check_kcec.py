@@ -0,0 +1,114 @@
+#! /usr/bin/python3
+
+# Test of the kernel CEC client with the vivid virtual CEC adapters
+#
+# With the default vivid configuration (modprobe vivid) /dev/cec0 is the HDMI input
+# adapter which acts as the TV and /dev/cec1 the HDMI output adapter used for the Z906.
+# The TV sends key presses and queries to the audio system and checks the events and replies.
+
+import fcntl
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import kcecclient as k
+
+CEC_MODE_INITIATOR      = 0x01
+CEC_MODE_FOLLOWER       = 0x10
+
+CEC_LOG_ADDR_TYPE_TV    = 0
+CEC_OP_PRIM_DEVTYPE_TV  = 0
+CEC_OP_ALL_DEVTYPE_TV   = 0x80
+
+AUDIO_SYSTEM            = 5
+
+
+class FakeTV():
+
+    def __init__(self, device):
+        self.fd = os.open(device, os.O_RDWR)
+        fcntl.ioctl(self.fd, k.CEC_S_MODE, struct.pack('<I', CEC_MODE_INITIATOR | CEC_MODE_FOLLOWER))
+        fcntl.ioctl(self.fd, k.CEC_ADAP_S_LOG_ADDRS, bytes(k.LOG_ADDRS.size))
+        log_addrs = bytearray(k.LOG_ADDRS.pack(b'', 0, k.CEC_OP_CEC_VERSION_1_4, 1, k.CEC_VENDOR_ID_NONE, 0, b'TV',
+                bytes((CEC_OP_PRIM_DEVTYPE_TV,)), bytes((CEC_LOG_ADDR_TYPE_TV,)), bytes((CEC_OP_ALL_DEVTYPE_TV,)), b''))
+        fcntl.ioctl(self.fd, k.CEC_ADAP_S_LOG_ADDRS, log_addrs, True)
+
+    def transmit(self, data, reply=0):
+        """
+        Send data to the audio system, wait for the reply opcode if any and return it.
+        """
+        msg = bytes((AUDIO_SYSTEM,)) + bytes(data)
+        buf = bytearray(k.MSG.pack(0, 0, len(msg), 1000 if reply else 0, 0, 0, msg, reply, 0, 0, 0, 0, 0, 0, 0))
+        fcntl.ioctl(self.fd, k.CEC_TRANSMIT, buf, True)
+        if not buf[k.MSG_TX_STATUS_OFFSET] & k.CEC_TX_STATUS_OK:
+            raise Exception("Transmit of " + bytes(data).hex(':') + " failed, status {:02x}".format(buf[k.MSG_TX_STATUS_OFFSET]))
+        length = buf[k.MSG_LEN_OFFSET]
+        return bytes(buf[k.MSG_DATA_OFFSET + 1:k.MSG_DATA_OFFSET + length])
+
+    def close(self):
+        os.close(self.fd)
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Kernel CEC client test with vivid")
+    argparser.add_argument('--tv', dest='tv', help='CEC device of the TV', default='/dev/cec0')
+    argparser.add_argument('--device', '-D', dest='device', help='CEC device of the audio system', default='/dev/cec1')
+    args = argparser.parse_args(argv)
+
+    events = []
+    client = k.KernelCecClient("Z906", args.device)
+    client.setEventCallback(lambda evt, val=None: events.append((evt, val)))
+    if client.open() is False:
+        sys.exit(1)
+    client.setAudioStatus(20, False)
+
+    tv = FakeTV(args.tv)
+    failures = []
+
+    def wait_events(count):
+        deadline = time.monotonic() + 1
+        while len(events) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    if client.logical_address != AUDIO_SYSTEM:
+        failures.append("Claimed logical address " + str(client.logical_address))
+
+    tv.transmit((0x44, 0x41))
+    tv.transmit((0x45,))
+    tv.transmit((0x44, 0x42))
+    wait_events(2)
+    if events != [ ('level_up', 1), ('level_down', 1) ]:
+        failures.append("Unexpected key events " + str(events))
+
+    ret = tv.transmit((0x71,), reply=0x7a)
+    if ret != bytes((0x7a, 20)):
+        failures.append("Unexpected audio status " + ret.hex(':'))
+
+    ret = tv.transmit((0x7d,), reply=0x7e)
+    if ret != bytes((0x7e, 0x01)):
+        failures.append("Unexpected system audio mode status " + ret.hex(':'))
+
+    # Reply latency
+    count = 100
+    start = time.perf_counter()
+    for i in range(count):
+        tv.transmit((0x8f,), reply=0x90)
+    print("Give power status round trip : {:.2f} ms".format((time.perf_counter() - start) * 1000 / count))
+
+    tv.close()
+    client.close()
+
+    for f in failures:
+        print("FAILED : " + f)
+    if failures:
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#! /usr/bin/python3
+
+# Long running soak test of the CEC and Bluetooth daemons against the simulator.
+#
+# Synthetic CEC frames are fed to CecClient._cmdCallback and BlueZ-like signals
+# to the BTClient handlers. RSS, object counts and latency percentiles are sampled
+# periodically and compared to the values measured after the warm up.
+# The state cached by the clients is compared with the one of the simulated amps
+# after each sample, after reading the status again when commands are dropped.
+# Exit with an error when memory grows, latency drifts past the thresholds or the states differ.
+
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import btclient
+import cecclient
+import z906bt
+import z906cec
+import z906client
+import z906sim
+
+# CEC frames with their relative frequency
+CEC_FRAMES = [
+    (">> 05:44:41", 10), (">> 05:44:42", 10), (">> 05:45", 20), (">> 05:44:43", 1),
+    (">> 05:71", 10), (">> 05:7d", 3), (">> 05:8f", 5), (">> 05:70:00:00", 2), (">> 05:9f", 1),
+    (">> 0f:87:00:e0:91", 5), (">> 0f:82:10:00", 1), (">> 0f:82:20:00", 1),
+    (">> 0f:80:10:00:20:00", 1), (">> 05:c3", 1), (">> 05:c4", 1), (">> 05:a0:00:00:f0", 1) ]
+
+MEDIA_TRANSPORT = 'org.bluez.MediaTransport1'
+
+
+class FakeBus():
+    """
+    Stand-in for the D-Bus system bus, keeps the registered signal handlers.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def add_signal_receiver(self, handler, dbus_interface=None, signal_name=None, path_keyword=None):
+        self.handlers[signal_name] = handler
+
+
+class BTDriver():
+    """
+    Generate the signals of phones connecting, playing, changing the volume and disconnecting.
+    """
+
+    def __init__(self, bus, rnd):
+        self.bus = bus
+        self.rnd = rnd
+        self.transports = []
+        self.num = 0
+
+    def step(self):
+        h = self.bus.handlers
+        op = self.rnd.randrange(10)
+        if op == 0 or not self.transports:
+            self.num += 1
+            path = "/org/bluez/hci0/dev_00_11_22_33_44_55/sep1/fd" + str(self.num)
+            self.transports.append(path)
+            h['InterfacesAdded'](path, { MEDIA_TRANSPORT: { 'State': 'idle', 'Volume': 64 } })
+        elif op == 1:
+            path = self.transports.pop(self.rnd.randrange(len(self.transports)))
+            h['InterfacesRemoved'](path, [ MEDIA_TRANSPORT ])
+        elif op < 4:
+            path = self.rnd.choice(self.transports)
+            h['PropertiesChanged'](MEDIA_TRANSPORT, { 'State': self.rnd.choice([ 'pending', 'idle' ]) }, [], path=path)
+        else:
+            path = self.rnd.choice(self.transports)
+            h['PropertiesChanged'](MEDIA_TRANSPORT, { 'Volume': self.rnd.randrange(128) }, [], path=path)
+
+
+def rss():
+    """
+    Resident set size in bytes.
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def compare_state(z906, sim, resync):
+    """
+    Return the differences between the state cached by the client and the simulated amp.
+
+    resync: read the status from the amp first, to recover from the dropped commands
+    """
+    def run():
+        for i in range(10 if resync else 0):
+            try:
+                z906.update()
+                break
+            except TimeoutError:
+                # The status request was dropped too
+                pass
+        return z906.get_state()
+    state = z906.submit(run).result()
+
+    amp = {
+        'main': sim.get_field(sim.STATUS_MAIN_LEVEL),
+        'rear': sim.get_field(sim.STATUS_REAR_LEVEL),
+        'center': sim.get_field(sim.STATUS_CENTER_LEVEL),
+        'sub': sim.get_field(sim.STATUS_SUB_LEVEL),
+        'input': sim.get_field(sim.STATUS_CURRENT_INPUT) + 1,
+        'headphones': bool(sim.get_field(sim.STATUS_HEADPHONES)) }
+    if not resync:
+        # Not part of the status, can't be recovered after a dropped command
+        amp['muted'] = sim.muted
+
+    return [ "{} is {} in the client and {} in the amp".format(key, state[key], val) for key, val in amp.items() if state[key] != val ]
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 daemons soak test")
+    argparser.add_argument('--duration', '-t', dest='duration', help='Duration in seconds', default=3600, type=float)
+    argparser.add_argument('--rate', '-r', dest='rate', help='Events per second, 0 for as fast as possible', default=50, type=float)
+    argparser.add_argument('--interval', '-i', dest='interval', help='Sampling interval in seconds', default=60, type=float)
+    argparser.add_argument('--warmup', '-w', dest='warmup', help='Number of samples before the baseline', default=2, type=int)
+    argparser.add_argument('--latency', '-l', dest='latency', help='Simulated amp latency in ms', default=1.0, type=float)
+    argparser.add_argument('--drop-rate', dest='drop_rate', help='Probability of the amp ignoring a command', default=0.0, type=float)
+    argparser.add_argument('--max-rss-growth', dest='max_rss', help='Maximum RSS growth in MB', default=8.0, type=float)
+    argparser.add_argument('--max-objects-growth', dest='max_objects', help='Maximum growth of the number of objects in percent', default=10.0, type=float)
+    argparser.add_argument('--max-latency-drift', dest='max_drift', help='Maximum p99 latency increase factor', default=3.0, type=float)
+    argparser.add_argument('--seed', dest='seed', help='Random seed', default=None, type=int)
+    args = argparser.parse_args(argv)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    rnd = random.Random(args.seed)
+    latency = args.latency / 1000
+
+    # CEC daemon
+    cec_sim = z906sim.Z906Simulator(latency=latency, timeout=0.1, drop_rate=args.drop_rate)
+    cec_daemon = z906cec.Z906Cec(None, 1, [ '1' ], z906=z906client.Z906Client(ser=cec_sim), cecClient=cecclient.CecClient("Z906"))
+    cec_frames = [ f for f, weight in CEC_FRAMES for i in range(weight) ]
+
+    # Bluetooth daemon
+    bus = FakeBus()
+    bt_sim = z906sim.Z906Simulator(latency=latency, timeout=0.1, drop_rate=args.drop_rate)
+    bt_daemon = z906bt.Z906BT(None, 2, z906=z906client.Z906Client(ser=bt_sim), bt=btclient.BTClient(bus=bus))
+    bt_driver = BTDriver(bus, rnd)
+
+    start = time.monotonic()
+    next_sample = start + args.interval
+    samples = []
+    timings = { 'cec': [], 'bt': [] }
+    errors = 0
+    events = 0
+    failures = []
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}".format("time", "events", "rss MB", "objects", "cec p50", "cec p99", "bt p99", "errors"))
+
+    while time.monotonic() - start < args.duration:
+        if rnd.random() < 0.7:
+            kind = 'cec'
+            fn = cec_daemon.cecClient._cmdCallback
+            arg = rnd.choice(cec_frames)
+            t = time.perf_counter()
+            try:
+                fn(arg)
+            except Exception:
+                errors += 1
+        else:
+            kind = 'bt'
+            t = time.perf_counter()
+            try:
+                bt_driver.step()
+            except Exception:
+                errors += 1
+        timings[kind].append(time.perf_counter() - t)
+        events += 1
+
+        if args.rate:
+            delay = start + events / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if time.monotonic() < next_sample:
+            continue
+        next_sample += args.interval
+
+        gc.collect()
+        sample = {
+            'time': time.monotonic() - start,
+            'rss': rss(),
+            'objects': len(gc.get_objects()),
+            'cec_p50': percentile(timings['cec'], 0.5),
+            'cec_p99': percentile(timings['cec'], 0.99),
+            'bt_p99': percentile(timings['bt'], 0.99),
+            'transports': len(bt_daemon.bt.transports),
+            'errors': errors }
+        samples.append(sample)
+        timings = { 'cec': [], 'bt': [] }
+        print("{:8.0f} {:10d} {:10.1f} {:10d} {:8.2f}ms {:8.2f}ms {:8.2f}ms {:8d}".format(sample['time'], events, sample['rss'] / 1e6,
+            sample['objects'], sample['cec_p50'] * 1000, sample['cec_p99'] * 1000, sample['bt_p99'] * 1000, errors))
+        sys.stdout.flush()
+
+        if len(bt_daemon.bt.transports) != len(bt_driver.transports):
+            failures.append("BTClient tracks {} transports, {} exist".format(len(bt_daemon.bt.transports), len(bt_driver.transports)))
+            break
+
+        for name, daemon, sim in (('CEC', cec_daemon, cec_sim), ('BT', bt_daemon, bt_sim)):
+            for diff in compare_state(daemon.z906, sim, args.drop_rate > 0):
+                failures.append(name + " state differs : " + diff)
+        if failures:
+            break
+
+        if len(samples) <= args.warmup:
+            continue
+
+        base = samples[args.warmup - 1] if args.warmup else samples[0]
+        if sample['rss'] - base['rss'] > args.max_rss * 1e6:
+            failures.append("RSS grew by {:.1f} MB".format((sample['rss'] - base['rss']) / 1e6))
+        if sample['objects'] > base['objects'] * (1 + args.max_objects / 100):
+            failures.append("Number of objects grew from {} to {}".format(base['objects'], sample['objects']))
+        for key in ('cec_p99', 'bt_p99'):
+            if base[key] and sample[key] > base[key] * args.max_drift:
+                failures.append("{} latency drifted from {:.2f} ms to {:.2f} ms".format(key, base[key] * 1000, sample[key] * 1000))
+        if not args.drop_rate and errors:
+            failures.append(str(errors) + " errors without any fault injected")
+        if failures:
+            break
+
+    cec_daemon.z906.close()
+    bt_daemon.z906.close()
+
+    print("{} events, {} errors, {} commands dropped by the simulated amps".format(events, errors, cec_sim.dropped + bt_sim.dropped))
+    for f in failures:
+        print("FAILED : " + f)
+    if failures:
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#! /usr/bin/python3
+
+# Concurrency stress test of Z906Client against the simulator.
+# Many threads send requests at the same time, every response is checked
+# against the request which caused it. Exit with an error on any lost or
+# mismatched response.
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import z906client
+import z906frame
+import z906sim
+
+# Commands which don't change the levels
+NEUTRAL_CMDS = [ 0x02, 0x05, 0x10, 0x11, 0x38, 0x39, 0x14 ]
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, z906, num, iterations):
+        super().__init__(name="Worker-" + str(num))
+        self.z906 = z906
+        self.rnd = random.Random(num)
+        self.iterations = iterations
+        self.requests = 0
+        self.errors = []
+
+    def check(self, cmd, ret):
+        self.requests += 1
+        if ret is None:
+            self.errors.append("lost response for {:02x}".format(cmd))
+        elif cmd in self.z906.extended_responses:
+            if not z906frame.is_valid(ret) or ret[1] != self.z906.extended_responses[cmd]:
+                self.errors.append("invalid response for {:02x} : {}".format(cmd, z906frame.to_hex(ret)))
+        elif bytes(ret) != bytes((cmd,)):
+            self.errors.append("mismatched response for {:02x} : {}".format(cmd, z906frame.to_hex(ret)))
+
+    def run(self):
+        for i in range(self.iterations):
+            op = self.rnd.randrange(4)
+            if op == 0:
+                # Pipelined burst, volume up and down so the level is unchanged
+                cmds = [ 0x08, 0x34, 0x09, self.rnd.choice(NEUTRAL_CMDS), 0x25 ]
+                for cmd, ret in zip(cmds, self.z906.request_many(cmds)):
+                    self.check(cmd, ret)
+            elif op == 1:
+                # Futures from several requests at once
+                cmds = [ self.rnd.choice(NEUTRAL_CMDS) for j in range(3) ]
+                futures = [ self.z906.submit(self.z906.command, cmd) for cmd in cmds ]
+                for cmd, f in zip(cmds, futures):
+                    self.check(cmd, f.result())
+            elif op == 2:
+                self.check(self.z906.GET_STATUS, self.z906.command(self.z906.GET_STATUS))
+            else:
+                # State changes must not be lost
+                self.z906.level_up('rear')
+                self.z906.level_down('rear')
+                self.requests += 2
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906Client concurrency stress test")
+    argparser.add_argument('--threads', '-t', dest='threads', help='Number of threads', default=16, type=int)
+    argparser.add_argument('--iterations', '-n', dest='iterations', help='Iterations per thread', default=200, type=int)
+    argparser.add_argument('--latency', '-l', dest='latency', help='Simulated response latency in ms', default=0.2, type=float)
+    args = argparser.parse_args(argv)
+
+    sim = z906sim.Z906Simulator(latency=args.latency / 1000)
+    z906 = z906client.Z906Client(ser=sim)
+    z906.update()
+    rear = z906.get_level('rear')
+    main_level = z906.get_level('main')
+
+    workers = [ Worker(z906, i, args.iterations) for i in range(args.threads) ]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    duration = time.perf_counter() - start
+
+    errors = [ e for w in workers for e in w.errors ]
+    requests = sum(w.requests for w in workers)
+
+    if z906.get_level('rear') != rear or sim.get_field(sim.STATUS_REAR_LEVEL) != rear:
+        errors.append("rear level changed : {} (client) {} (amp), expected {}".format(z906.get_level('rear'), sim.get_field(sim.STATUS_REAR_LEVEL), rear))
+    if sim.get_field(sim.STATUS_MAIN_LEVEL) != main_level:
+        errors.append("main level changed : {}, expected {}".format(sim.get_field(sim.STATUS_MAIN_LEVEL), main_level))
+    # One update() before the workers started
+    if sim.commands != requests + 1:
+        errors.append("{} requests sent but the amp received {}".format(requests, sim.commands - 1))
+
+    z906.close()
+
+    print("{} requests from {} threads in {:.2f} s ({:.0f} requests/s)".format(requests, args.threads, duration, requests / duration))
+    for e in errors[:20]:
+        print("ERROR : " + e)
+    if errors:
+        print(str(len(errors)) + " errors")
+        sys.exit(1)
+    print("No errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,8 @@
 
 import btclient
 import z906client
+import z906shm
 import logging
-import argparse
-
-
-argparser = argparse.ArgumentParser(description="Logitech Z906 BT translator")
-argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
-argparser.add_argument('--port', '-P', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
-argparser.add_argument('--input', '-i', dest='input', help='Z906 input to use (1-6)', default=1, type=int)
 
 
 class Z906BT():
@@ -21,16 +15,26 @@ class Z906BT():
     bt_input = None
 
 
-    def __init__(self, z906_port, z906_input):
+    def __init__(self, z906_port, z906_input, z906 = None, bt = None):
+        """
+        z906, bt: already created Z906Client and BTClient to use
+        """
 
         self.logger.info("Connecting to Z906 ...")
-        self.z906 = z906client.Z906Client(z906_port)
+        self.z906 = z906 or z906client.Z906Client(z906_port)
         self.logger.debug("Connected to Z906")
 
-        self.bt = btclient.BTClient(self.evtCallback)
+        if bt:
+            bt.callback = self.evtCallback
+        else:
+            bt = btclient.BTClient(self.evtCallback)
+        self.bt = bt
         self.bt_input = z906_input
 
     def __del__(self):
+        if not self.z906.ser:
+            # Client already closed
+            return
         self.logger.info("Powering off Z906 ...")
         self.z906.power_off()
 
@@ -52,30 +56,60 @@ class Z906BT():
             cur_vol = self.z906.get_level()
             new_vol = int(43.0 / 127.0 * float(val))
             self.logger.debug("BT Volume : " + str(val) + " Z906 Volume : " + str(new_vol))
-            if new_vol > cur_vol:
-                for i in range(new_vol - cur_vol):
-                    self.z906.level_up()
-            else:
-                for i in range(cur_vol - new_vol):
-                    self.z906.level_down()
+            steps = self.z906.level_step(new_vol - cur_vol)
+            self.logger.debug("Z906 Volume moved by " + str(steps) + " to " + str(self.z906.get_level()))
             
 
     def mainloop(self):
         self.bt.mainloop()
 
-if __name__ == "__main__":
-    args = argparser.parse_args()
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Logitech Z906 BT translator")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--port', '-P', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
+    argparser.add_argument('--input', '-i', dest='input', help='Z906 input to use (1-6)', default=1, type=int)
+    argparser.add_argument('--backend', '-b', dest='backend', help='D-Bus backend, dbus-python with GLib or dbus-next with asyncio', default='dbus', choices=[ 'dbus', 'asyncio' ])
+    argparser.add_argument('--telemetry', '-t', dest='telemetry', help='Record telemetry to this file', default=None)
+    argparser.add_argument('--telemetry-rate', '-r', dest='telemetry_rate', help='Telemetry sampling interval in seconds', default=10.0, type=float)
+    argparser.add_argument('--publish', dest='publish', help='Publish the status to this shared memory file', default=None, nargs='?', const=z906shm.DEFAULT_PATH)
+    argparser.add_argument('--trace', dest='trace', help='Write latency traces to this file', default=None)
+    args = argparser.parse_args(argv)
+
+    if args.trace:
+        import z906trace
+        z906trace.enable(args.trace)
+
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
 
-    z906bt = Z906BT(args.port, args.input)
+    bt = None
+    if args.backend == 'asyncio':
+        import aiobtclient
+        bt = aiobtclient.AioBTClient()
+
+    z906bt = Z906BT(args.port, args.input, bt=bt)
+
+    if args.publish:
+        z906shm.publish(z906bt.z906, args.publish)
+
+    if args.telemetry:
+        import z906telemetry
+        sampler = z906telemetry.TelemetrySampler(z906bt.z906, z906telemetry.TelemetryRing(args.telemetry), args.telemetry_rate)
+        sampler.start()
 
     try:
         z906bt.mainloop()
     except KeyboardInterrupt:
         pass
 
-    
+    if args.trace:
+        z906trace.disable()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,35 +2,34 @@
 
 import cecclient
 import z906client
+import z906shm
+import sys
 import time
-import traceback
-import argparse
 import logging
 
 
-argparser = argparse.ArgumentParser(description="Logitech Z906 CEC translator")
-argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
-argparser.add_argument('--port', '-P', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
-argparser.add_argument('--input', '-i', dest='input', help='Z906 input to use (1-6)', default=1, type=int)
-argparser.add_argument('--address', '-a', dest='enabled', help='Enabled ARC only for certain HDMI ports', action='append')
-
-
 class Z906Cec():
 
     enabled_hdmi_ports = None
     z906 = None
+    z906_input = 1
     cecClient = None
     logger = logging.getLogger("Z906Cec")
 
 
-    def __init__(self, z906_port, z906_input, enabled_ports = None):
+    def __init__(self, z906_port, z906_input, enabled_ports = None, z906 = None, cecClient = None, volume_curve = None):
+        """
+        z906, cecClient: already created Z906Client and opened CecClient to use
+        volume_curve: volume steps per key press according to the number of repeats of a held key
+        """
     
         self.enabled_hdmi_ports = enabled_ports
+        self.z906_input = z906_input
         self.logger.info("Enabled HDMI ports : " + str(enabled_ports))
 
         # Init the Z906
         self.logger.info("Connecting to Z906 ...")
-        self.z906 = z906client.Z906Client(z906_port)
+        self.z906 = z906 or z906client.Z906Client(z906_port)
         self.z906.update()
         self.z906.power_off()
         self.logger.debug("Connected to Z906")
@@ -38,28 +37,41 @@ class Z906Cec():
 
         # Init CEC
         self.logger.info("Initiating CEC ...")
-        self.cecClient = cecclient.CecClient("Z906")
-        self.cecClient.open()
+        if not cecClient:
+            cecClient = cecclient.CecClient("Z906", volume_curve)
+            cecClient.open()
+        self.cecClient = cecClient
         self.logger.debug("CEC initialized")
         self.cecClient.setEventCallback(self._cecCallback)
 
+        # Keep the audio status reported to the TV up to date
+        self.cecClient.setAudioStatus(self.z906.get_level(), self.z906.is_muted())
+        self.z906.add_state_callback(self._stateCallback)
+
     
         self.logger.info("Ready !")
 
     def __del__(self):
+        if not self.z906.ser:
+            # Client already closed
+            return
         self.logger.info("Powering off Z906")
         self.z906.power_off()
 
-    def _cecCallback(self, evt):
+    def _stateCallback(self, state):
+        self.cecClient.setAudioStatus(state['main'], state['muted'])
+
+    def _cecCallback(self, evt, val = None):
 
 
         self.logger.debug("Got event " + evt)
 
         if evt == "level_up":
-            self.z906.level_up()
+            # The steps of a held key are sent in a single burst
+            self.z906.level_step(val or 1)
             self.cecClient.reportAudioStatus(self.z906.get_level(), self.z906.is_muted())
         elif evt == "level_down":
-            self.z906.level_down()
+            self.z906.level_step(-(val or 1))
             self.cecClient.reportAudioStatus(self.z906.get_level(), self.z906.is_muted())
         elif evt == "mute":
             self.z906.mute_toggle()
@@ -71,7 +83,7 @@ class Z906Cec():
         elif evt == "arc_start":
             if self.cecClient.is_enabled():
                 self.z906.power_on()
-                self.z906.select_input(z906_input)
+                self.z906.select_input(self.z906_input)
         elif evt == "arc_stop":
             if self.cecClient.is_enabled():
                 self.z906.power_off()
@@ -89,25 +101,68 @@ class Z906Cec():
                 if src_port.startswith(p):
                     self.cecClient.enable()
                     self.z906.power_on()
-                    self.z906.select_input(z906_input)
+                    self.z906.select_input(self.z906_input)
                     return
             self.cecClient.disable()
             self.z906.power_off()
 
                 
-if __name__ == "__main__":
-    args = argparser.parse_args()
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Logitech Z906 CEC translator")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--port', '-P', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
+    argparser.add_argument('--input', '-i', dest='input', help='Z906 input to use (1-6)', default=1, type=int)
+    argparser.add_argument('--telemetry', '-t', dest='telemetry', help='Record telemetry to this file', default=None)
+    argparser.add_argument('--telemetry-rate', '-r', dest='telemetry_rate', help='Telemetry sampling interval in seconds', default=10.0, type=float)
+    argparser.add_argument('--trace', dest='trace', help='Write latency traces to this file', default=None)
+    argparser.add_argument('--publish', dest='publish', help='Publish the status to this shared memory file', default=None, nargs='?', const=z906shm.DEFAULT_PATH)
+    argparser.add_argument('--volume-curve', '-c', dest='volume_curve', help='Volume steps per repeat of a held key, e.g. 1,1,2,4', default=None, type=lambda s: [ int(x) for x in s.split(',') ])
+    argparser.add_argument('--cec-device', '-D', dest='cec_device', help='Use the kernel CEC device instead of libcec, e.g. /dev/cec0', default=None)
+    argparser.add_argument('--address', '-a', dest='enabled', help='Enabled ARC only for certain HDMI ports', action='append')
+    args = argparser.parse_args(argv)
+
+    if args.trace:
+        import z906trace
+        z906trace.enable(args.trace)
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
-    z906cec = Z906Cec(args.port, args.input, args.enabled)
+    cecClient = None
+    if args.cec_device:
+        import kcecclient
+        cecClient = kcecclient.KernelCecClient("Z906", args.cec_device, args.volume_curve)
+        try:
+            opened = cecClient.open()
+        except OSError as e:
+            logging.critical("Unable to open " + args.cec_device + " : " + str(e))
+            return 1
+        if not opened:
+            return 1
+
+    z906cec = Z906Cec(args.port, args.input, args.enabled, cecClient=cecClient, volume_curve=args.volume_curve)
+
+    if args.publish:
+        z906shm.publish(z906cec.z906, args.publish)
+
+    if args.telemetry:
+        import z906telemetry
+        sampler = z906telemetry.TelemetrySampler(z906cec.z906, z906telemetry.TelemetryRing(args.telemetry), args.telemetry_rate)
+        sampler.start()
 
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
 
-while True:
-    try:
-        time.sleep(1)
-    except KeyboardInterrupt:
-        break
+    if args.trace:
+        z906trace.disable()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
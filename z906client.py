@@ -4,13 +4,34 @@
 # This is a client for the z906 soundsystem
 # Most of the serial code is a reimplementation of https://github.com/zarpli/Logitech-Z906
 
-import serial
+import concurrent.futures
+import contextvars
+import functools
+import itertools
 import logging
+import queue
+import threading
 import time
 
+import z906flow
+import z906frame
+import z906trace
+
 SERIAL_PORT = '/dev/ttyAMA0'
 TIMEOUT = 5
 
+# Commands which can be sent without knowing the current status of the Z906
+FAST_COMMANDS = ( '+', '-', 'mute on', 'mute off', 'm on', 'm off', 'off' )
+
+
+def serialized(fn):
+    """
+    Run the decorated method in the I/O thread of the client.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        return self._call(fn, self, *args, **kwargs)
+    return wrapper
 
 
 class Z906Client():
@@ -50,93 +71,342 @@ class Z906Client():
     STATUS_CHECKSUM         = 23
 
 
-    status = [ 0 ] * STATUS_TOTAL_LENGTH
+    # Status response
+    STATUS_TYPE         = 0x0A
+
+    # Temperature response
+    TEMP_TYPE           = 0x0C
+    TEMP_FIELD          = 6
+
+    # Priorities of the requests, lowest value first
+    PRIORITY_USER       = 0
+    PRIORITY_LOW        = 10
 
-    muted = False
     ser = None
 
+    # Time to wait for more data after a single byte response
+    ack_wait = .1
+
+    # Maximum number of commands in flight when pipelining
+    window = 4
+
+    # Type of the extended response of the requests, others are acknowledged by an echo
+    extended_responses = { GET_TEMP: TEMP_TYPE, GET_STATUS: STATUS_TYPE }
+
+    # Effect field of each input
+    input_fx_fields = [ STATUS_FX_INPUT_1, STATUS_FX_INPUT_2, STATUS_FX_INPUT_3, STATUS_FX_INPUT_4, STATUS_FX_INPUT_5, STATUS_FX_INPUT_AUX ]
+
+    # Up and down commands of each speaker
+    level_cmds = {
+            'main': (0x08, 0x09),
+            'sub': (0x0A, 0x0B),
+            'center': (0x0C, 0x0D),
+            'rear': (0x0E, 0x0F) }
+
     speaker_fields = {
             'main': STATUS_MAIN_LEVEL,
             'rear': STATUS_REAR_LEVEL,
             'center': STATUS_CENTER_LEVEL,
             'sub': STATUS_SUB_LEVEL }
 
-    def __init__(self, serial_port=SERIAL_PORT):
+    def __init__(self, serial_port=SERIAL_PORT, ser=None, flow=None):
+        """
+        serial_port: path of the serial port connected to the Z906
+        ser: already opened serial-like object to use instead of serial_port
+        flow: z906flow.FlowControl limiting the command rates, by default the calibrated profile of serial_port is used, False to disable
+        """
         self.logger = logging.getLogger("Z906Client")
-        self.ser = serial.Serial(serial_port, baudrate=57600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_ODD, stopbits=serial.STOPBITS_ONE, timeout=5)
+        self.status = [ 0 ] * self.STATUS_TOTAL_LENGTH
+        self.status_valid = False
+        self.muted = False
+        self.temp = None
+        self.state_callbacks = []
+
+        rates = None
+        if ser is None:
+            import serial
+            ser = serial.Serial(serial_port, baudrate=57600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_ODD, stopbits=serial.STOPBITS_ONE, timeout=TIMEOUT)
+            if flow is None:
+                rates = z906flow.load_profile(serial_port)
+                if rates:
+                    self.logger.debug("Using flow control profile " + str(rates))
+        self.ser = ser
+        self.flow = flow or z906flow.FlowControl(rates)
+
+        self.reader = z906frame.FrameReader(self.ser)
+        self.txbuf = bytearray(z906frame.frame_length(z906frame.MAX_DATA_LENGTH))
+
+        # All the I/O and state changes happen in a single thread, started by the first request
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.io_thread = None
+        self.io_lock = threading.Lock()
+        self.closed = False
 
     def __del__(self):
         if self.ser:
             self.ser.close()
 
+    def close(self):
+        """
+        Stop the I/O thread once the pending requests are done and close the serial port.
+        Requests made once close() is called raise a RuntimeError.
+        """
+        with self.io_lock:
+            self.closed = True
+            if self.io_thread:
+                # Processed after all the requests already queued
+                self.queue.put((self.PRIORITY_LOW + 1, next(self.seq), None, None, None, None, None))
+        if self.io_thread:
+            self.io_thread.join()
+        if self.ser:
+            self.ser.close()
+            self.ser = None
 
-    def _cksum(self, data):
-        cksum = 0
-        for b in data[1:-1]:
-            cksum += b
-        return 0x100 - (cksum & 0xFF)
+    def _ioLoop(self):
+        while True:
+            priority, seq, submitted, future, ctx, fn, args = self.queue.get()
+            if future is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                ctx.run(z906trace.complete, "queue_wait", submitted)
+                future.set_result(ctx.run(self._run, fn, args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _run(self, fn, args):
+        with z906trace.span(getattr(fn, '__name__', 'call')):
+            return fn(*args)
 
+    def submit(self, fn, *args, priority=PRIORITY_USER):
+        """
+        Queue a call to fn in the I/O thread and return a concurrent.futures.Future.
+        Calls with a lower priority value are executed first.
+        """
+        future = concurrent.futures.Future()
+        with self.io_lock:
+            if self.closed:
+                raise RuntimeError("Z906Client is closed")
+            if self.io_thread is None:
+                self.io_thread = threading.Thread(target=self._ioLoop, name="Z906Client", daemon=True)
+                self.io_thread.start()
+            self.queue.put((priority, next(self.seq), z906trace.now(), future, contextvars.copy_context(), fn, args))
+        return future
+
+    def pending(self):
+        """
+        Return the number of queued requests.
+        """
+        return self.queue.qsize()
+
+    def _call(self, fn, *args, **kwargs):
+        if kwargs:
+            fn = functools.partial(fn, **kwargs)
+        if threading.current_thread() is self.io_thread:
+            return fn(*args)
+        return self.submit(fn, *args).result()
+
+
+    @serialized
     def request_ex(self, req_type, data):
-        req = [ 0xAA, req_type, len(data) ]
-        req.extend(data)
-        req.append(0x0)
-        req[-1] = self._cksum(req)
-        self.logger.debug("Request : " + ' '.join('{:02x}'.format(x) for x in req))
+        req = z906frame.build(req_type, data, self.txbuf)
+        self.logger.debug("Request : " + z906frame.to_hex(req))
         return self.request(req)
 
 
+    @serialized
     def request(self, cmd):
-        if not isinstance(cmd, list):
-            cmd = [cmd]
+        """
+        Send a single byte command or a complete frame and wait for the response.
+
+        Return the response as a bytearray, None if there is no response.
+        """
+        if isinstance(cmd, int):
+            cmd = bytes((cmd,))
+        elif isinstance(cmd, list):
+            cmd = bytes(cmd)
 
         if self.ser.in_waiting > 0:
             self.logger.debug("Discarding " + str(self.ser.in_waiting) + " bytes of response")
         self.ser.reset_input_buffer()
-        self.ser.write(bytes(cmd))
-
+        if len(cmd) == 1 and self.flow.costs:
+            with z906trace.span("flow_wait"):
+                self.flow.wait(cmd[0])
+        with z906trace.span("serial_write", cmd=cmd.hex()):
+            self.ser.write(cmd)
+
+        with z906trace.span("ack_wait"):
+            ret = self._wait_response()
+        # The frame reader buffer is reused by the next request, which may come from another thread
+        return None if ret is None else bytearray(ret)
+
+    def _wait_response(self):
+        """
+        Wait for a single byte or an extended response.
+        """
         ret = None
 
         while True:
-            ret = bytearray(self.ser.read(1))
+            ret = self.ser.read(1)
             if len(ret) == 0:
                 self.logger.warning("No response from the AMP !")
                 return None
             # Either single byte response or full len response
-            if ret[0] == 0xAA: # We got an  extended response
+            if ret[0] == z906frame.FRAME_START: # We got an  extended response
                 break
             else: # One byte response, let's see if there is more ...
-                time.sleep(.1)
+                time.sleep(self.ack_wait)
                 self.logger.debug(("Response: {:02x}" .format(ret[0])))
                 if self.ser.in_waiting == 0:
-                    return ret
+                    return bytearray(ret)
 
         # Only extended responses at this point
-        ret.extend(bytearray(self.ser.read(2)))
-        l = ret[2]
-        ret.extend(bytearray(self.ser.read(l + 1)))
+        ret = self.reader.read_frame(ret[0])
+        if ret is None:
+            self.logger.warning("Truncated response from the AMP !")
+            return None
 
-        cksum = self._cksum(ret)
-
-        self.logger.debug("Response: " + ' '.join('{:02x}'.format(x) for x in ret) + " (cksum " + ( "OK" if cksum == ret[-1] else "INALID") + ")" )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Response: " + z906frame.to_hex(ret) + " (cksum " + ( "OK" if z906frame.is_valid(ret) else "INVALID") + ")" )
         return ret
 
+    def _read_response(self):
+        """
+        Read a single response without waiting for more data.
+        """
+        ret = self.ser.read(1)
+        if len(ret) == 0:
+            return None
+        if ret[0] != z906frame.FRAME_START:
+            return bytearray(ret)
+        frame = self.reader.read_frame(ret[0])
+        if frame is None:
+            return None
+        return bytearray(frame)
+
+    def _response_matches(self, cmd, ret, echo=True):
+        """
+        echo: only accept the echo of cmd as acknowledgement, otherwise any single byte
+        """
+        if cmd in self.extended_responses:
+            return len(ret) > 1 and ret[0] == z906frame.FRAME_START and ret[1] == self.extended_responses[cmd]
+        return len(ret) == 1 and (ret[0] == cmd or not echo)
+
+    @serialized
+    def request_many(self, cmds, window=None):
+        """
+        Send single byte commands, keeping up to window commands in flight.
+
+        Responses are matched to the commands in order. Commands are normally acknowledged
+        by their echo, a single byte which isn't the echo of any command in flight acknowledges
+        the oldest one, as it did before pipelining. The input buffer is only flushed when a
+        response is missing.
+        Return the list of responses, None for the commands which were not acknowledged.
+        """
+        if not window:
+            window = self.window
+
+        results = [ None ] * len(cmds)
+        sent = 0
+        done = 0
+
+        while done < len(cmds):
+            while sent < len(cmds) and sent - done < window:
+                if self.flow.costs:
+                    with z906trace.span("flow_wait"):
+                        self.flow.wait(cmds[sent])
+                with z906trace.span("serial_write", cmd=cmds[sent]):
+                    self.ser.write(bytes((cmds[sent],)))
+                sent += 1
+
+            with z906trace.span("ack_wait"):
+                ret = self._read_response()
+            if ret is None:
+                # Desync, drop everything and forget about the commands in flight
+                self.logger.warning("No response from the AMP for " + str(sent - done) + " commands !")
+                self.ser.reset_input_buffer()
+                done = sent
+                continue
+
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Response: " + z906frame.to_hex(ret))
+
+            # Check if a response was skipped, the echo first then any single byte
+            for echo in (True, False):
+                match = next((i for i in range(done, sent) if self._response_matches(cmds[i], ret, echo)), None)
+                if match is not None:
+                    break
+            if match is None:
+                self.logger.debug("Ignoring unexpected response " + z906frame.to_hex(ret))
+                continue
+            if match != done:
+                self.logger.warning("Missing response for " + str(match - done) + " commands")
+            results[match] = ret
+            done = match + 1
+
+        return results
+
+    def command(self, cmd):
+        """
+        Send a single byte command and wait for its response.
+        """
+        return self.request_many((cmd,))[0]
+
     def print_status(self):
 
-        self.logger.debug("Status : " + ''.join('{:02x}'.format(x) for x in self.status))
+        self.logger.debug("Status : " + bytes(self.status).hex())
         print("Levels : main " + str(self.status[self.STATUS_MAIN_LEVEL]) + "/43, center " + str(self.status[self.STATUS_CENTER_LEVEL]) + "/43, subwoofer " + str(self.status[self.STATUS_SUB_LEVEL]) + "/43, rear " + str(self.status[self.STATUS_REAR_LEVEL]) + "/43")
         print("Current input : " + str(self.status[self.STATUS_CURRENT_INPUT] + 1))
         print("Headphones : " + ("enabled" if self.status[self.STATUS_HEADPHONES] else "disabled"))
 
 
+    @serialized
     def update(self):
 
         self.logger.debug("Updating status ...")
-        ret = self.request(self.GET_STATUS)
-        if len(ret) == 0:
+        ret = self.command(self.GET_STATUS)
+        if not ret:
             self.logger.critical("Unable to communicate with Z906 : read timeout")
             raise TimeoutError
         self.status = bytearray(ret)
+        self.status_valid = True
+        self._state_changed()
+
+    def get_state(self):
+        """
+        Return the known state of the Z906 as a dict.
+        """
+        status = self.status
+        return {
+            'valid': self.status_valid,
+            'main': status[self.STATUS_MAIN_LEVEL],
+            'rear': status[self.STATUS_REAR_LEVEL],
+            'center': status[self.STATUS_CENTER_LEVEL],
+            'sub': status[self.STATUS_SUB_LEVEL],
+            'input': status[self.STATUS_CURRENT_INPUT] + 1,
+            'muted': self.muted,
+            'headphones': bool(status[self.STATUS_HEADPHONES]),
+            'effect': status[self.input_fx_fields[status[self.STATUS_CURRENT_INPUT] % len(self.input_fx_fields)]],
+            'temperature': self.temp }
+
+    def add_state_callback(self, callback):
+        """
+        Register a callback called with get_state() after each state change.
+        Callbacks are called from the I/O thread of the client and must not block :
+        no serial request is processed while they run.
+        """
+        self.state_callbacks.append(callback)
+
+    def _state_changed(self):
+        if not self.state_callbacks:
+            return
+        state = self.get_state()
+        for cb in self.state_callbacks:
+            cb(state)
 
+    @serialized
     def level_up(self, spkr='main'):
 
         if spkr not in self.speaker_fields:
@@ -154,14 +424,22 @@ class Z906Client():
         elif spkr == 'rear':
             cmd = 0x0E
 
+        if not self.status_valid:
+            # Status unknown, we can't check nor track the level
+            self.command(cmd)
+            self.logger.info("Level for " + spkr + " up")
+            return
+
         if self.status[field] == self.VOLUME_MAX:
             raise ValueError("Volume level for " + spkr + " already at maximum")
 
-        ret = self.request(cmd)
+        ret = self.command(cmd)
         self.status[field] += 1
+        self._state_changed()
         self.logger.info("Level for " + spkr + " up to " + str(self.status[field]))
 
 
+    @serialized
     def level_down(self, spkr='main'):
 
         if spkr not in self.speaker_fields:
@@ -178,13 +456,62 @@ class Z906Client():
         elif spkr == 'rear':
             cmd = 0x0F
 
+        if not self.status_valid:
+            # Status unknown, we can't check nor track the level
+            self.command(cmd)
+            self.logger.info("Level for " + spkr + " down")
+            return
+
         if self.status[field] == 0:
             raise ValueError("Volume level for " + spkr + " already at minimum")
 
-        ret = self.request(cmd)
+        ret = self.command(cmd)
         self.status[field] -= 1
+        self._state_changed()
         self.logger.info("Level " + spkr + " down to " + str(self.status[field]))
 
+    @serialized
+    def level_step(self, steps, spkr='main'):
+        """
+        Move the level by several steps, up if positive and down if negative.
+        All the commands are pipelined and the state callbacks are called once.
+        Return the number of steps acknowledged by the amp, negative when going down,
+        0 if the level is already at its bound.
+        """
+
+        if spkr not in self.speaker_fields:
+            raise ValueError("Invalid speaker provided")
+
+        field = self.speaker_fields[spkr]
+        up, down = self.level_cmds[spkr]
+        cmd = up if steps > 0 else down
+
+        if self.status_valid:
+            # Don't go past the bounds
+            cur = self.status[field]
+            if steps > 0:
+                steps = min(steps, self.VOLUME_MAX - cur)
+            else:
+                steps = -min(-steps, cur)
+
+        if steps == 0:
+            return 0
+
+        results = self.request_many((cmd,) * abs(steps))
+        acked = len(results) - results.count(None)
+        steps = acked if steps > 0 else -acked
+        if steps == 0:
+            return 0
+
+        if not self.status_valid:
+            self.logger.info("Level for " + spkr + " moved by " + str(steps))
+            return steps
+
+        self.status[field] += steps
+        self._state_changed()
+        self.logger.info("Level for " + spkr + " moved by " + str(steps) + " to " + str(self.status[field]))
+        return steps
+
     def get_level(self, spkr='main'):
 
         if spkr not in self.speaker_fields:
@@ -194,6 +521,7 @@ class Z906Client():
         return self.status[field]
 
 
+    @serialized
     def select_input(self, input_num):
         """
         Select the input either by number or by name.
@@ -217,12 +545,16 @@ class Z906Client():
         if cmd == 0:
             raise ValueError("Invalid input number provided")
 
-        ret = self.request(cmd)
+        ret = self.command(cmd)
+        self.status[self.STATUS_CURRENT_INPUT] = 5 if input_num == 'aux' else input_num - 1
+        self._state_changed()
 
+    @serialized
     def get_input(self):
         self.update()
         return self.status[self.STATUS_CURRENT_INPUT] + 1
 
+    @serialized
     def mute(self, on):
         """
         Turn mute on or off.
@@ -235,9 +567,11 @@ class Z906Client():
         else:
             self.logger.debug("Unmuting")
             cmd = 0x39
-        ret = self.request(cmd)
+        ret = self.command(cmd)
         self.muted = on
+        self._state_changed()
 
+    @serialized
     def mute_toggle(self):
         """
         Toggle mute.
@@ -251,6 +585,7 @@ class Z906Client():
         """
         return self.muted
 
+    @serialized
     def headphones(self, on):
         """
         Turn on or off the headphones/
@@ -262,9 +597,12 @@ class Z906Client():
         else:
             self.logger.debug("No headphones")
             cmd = 0x11
-        ret = self.request(cmd)
+        ret = self.command(cmd)
+        self.status[self.STATUS_HEADPHONES] = 1 if on else 0
+        self._state_changed()
 
 
+    @serialized
     def effect(self, fx):
         """
         Set the effect for current input.
@@ -274,40 +612,65 @@ class Z906Client():
         cmd = 0
         if fx == "3d" or fx == "3D":
             cmd = 0x14
+            val = 0
         elif fx == "4.1":
             cmd = 0x15
+            val = 1
         elif fx == "2.1":
             cmd = 0x16
+            val = 2
         elif fx == "off":
             cmd = 0x35
+            val = 3
         else:
             raise ValueError("Unknown effect " + fx)
-        ret = self.request(cmd)
+        ret = self.command(cmd)
+        field = self.input_fx_fields[self.status[self.STATUS_CURRENT_INPUT] % len(self.input_fx_fields)]
+        self.status[field] = val
+        self._state_changed()
 
+    @serialized
     def temperature(self):
         """
-        Get the temperature.
+        Get the temperature in degrees Celsius or None if it can't be read.
         """
 
-        ret = self.request(0x25)
-        if ret[1] != 0xC:
-            print("Unable to read current temperature")
+        ret = self.command(self.GET_TEMP)
+        if not ret or len(ret) <= self.TEMP_FIELD or ret[1] != self.TEMP_TYPE or not z906frame.is_valid(ret):
+            self.logger.warning("Unable to read current temperature")
+            return None
+
+        if ret[self.TEMP_FIELD] != self.temp:
+            self.temp = ret[self.TEMP_FIELD]
+            self._state_changed()
+        return self.temp
 
-        print(str(ret[6]) + " C")
+    def print_temperature(self):
+        temp = self.temperature()
+        if temp is None:
+            print("Unable to read current temperature")
+        else:
+            print(str(temp) + " C")
 
+    @serialized
     def power_on(self):
         """
         Power on is achieved by turning off or on the headphones.
         """
-        self.headphones(False)
-        self.mute(False)
+        self.logger.debug("Powering on")
+        self.request_many((0x11, 0x39))
+        self.status[self.STATUS_HEADPHONES] = 0
+        self.muted = False
+        self._state_changed()
 
+    @serialized
     def power_off(self):
         """
         Power off the Z906.
         """
-        ret = self.request(0x37)
+        ret = self.command(0x37)
 
+    @serialized
     def parse_cmd(self, cmd):
 
         cmd = cmd.split()
@@ -331,7 +694,7 @@ class Z906Client():
             "effect": self._cmd_effect,
             "fx": self._cmd_effect,
             "raw": self._cmd_raw,
-            "temperature": lambda x: self.temperature(),
+            "temperature": lambda x: self.print_temperature(),
             "on": lambda x: self.power_on(),
             "off": lambda x: self.power_off(),
             }
@@ -351,10 +714,8 @@ class Z906Client():
             self.request(req)
         else:
             t = int(cmd[0], base=16)
-            data = []
-            for c in cmd[1:]:
-                data.append(int(c, base=16))
-            print("Sending req with type 0x{:02x}".format(t) + " and data " + ' '.join('{:02x}'.format(x) for x in data))
+            data = bytes(int(c, base=16) for c in cmd[1:])
+            print("Sending req with type 0x{:02x}".format(t) + " and data " + z906frame.to_hex(data))
             self.request_ex(t, data)
 
     def _cmd_input(self, cmd):
@@ -438,14 +799,30 @@ class Z906Client():
                 print(e)
 
 
-if __name__ == '__main__':
+def needs_status(cmds):
+    """
+    Check if the provided commands require the status of the Z906 to be fetched first.
+    """
+    for cmd in cmds:
+        if ' '.join(cmd.split()) not in FAST_COMMANDS:
+            return True
+    return False
+
+
+def main(argv=None):
 
     import argparse
     argparser = argparse.ArgumentParser(description="Logitech Z906 client")
     argparser.add_argument('--port', '-p', dest='port', help='Z906 serial port', default=SERIAL_PORT)
     argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
     argparser.add_argument('--command', '-c', dest='cmd', help='Execute a single command', action='append', default=None)
-    args = argparser.parse_args()
+    argparser.add_argument('--window', '-w', dest='window', help='Maximum number of commands in flight', default=Z906Client.window, type=int)
+    argparser.add_argument('--trace', dest='trace', help='Write latency traces to this file', default=None)
+    args = argparser.parse_args(argv)
+
+    if args.trace:
+        z906trace.enable(args.trace)
+
 
 
     if args.debug:
@@ -455,11 +832,21 @@ if __name__ == '__main__':
 
 
     z906 = Z906Client(args.port)
+    z906.window = args.window
 
     if not args.cmd:
         z906.update()
         z906.main_loop()
     else:
-        z906.update()
+        # Skip the status request when the commands don't need it
+        if needs_status(args.cmd):
+            z906.update()
         for cmd in args.cmd:
-            z906.parse_cmd(cmd)
+            with z906trace.begin("command", cmd=cmd):
+                z906.parse_cmd(cmd)
+
+    z906trace.disable()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+#! /usr/bin/python3
+
+# Flow control of the commands sent to the Z906
+#
+# The microcontroller of the amp drops the commands sent faster than it can
+# process them. It processes them one at a time, so all the commands share a
+# single token bucket of processing time. The rate of each class of opcodes
+# is measured by a probe and saved per device in a profile file, a command
+# costs the processing time of its class.
+
+import logging
+import os
+import time
+
+PROFILE_PATH = os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'z906', 'flow.json')
+
+# Opcode classes with the same processing time
+OPCODE_CLASSES = {
+        'level': (0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0E, 0x0F),
+        'input': (0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x14, 0x15, 0x16, 0x35),
+        'query': (0x25, 0x34),
+        'power': (0x10, 0x11, 0x37, 0x38, 0x39) }
+
+opcode_class = { op: cls for cls, ops in OPCODE_CLASSES.items() for op in ops }
+
+# Select input command of each input
+INPUT_CMDS = ( 0x02, 0x05, 0x03, 0x04, 0x06, 0x07 )
+
+logger = logging.getLogger("Z906Flow")
+
+
+class TokenBucket():
+    """
+    Token bucket paid after the fact : the tokens are taken when a request is
+    sent and the next request waits until they are paid back. Requests can have
+    different costs, a costly request delays the one which follows it.
+    """
+
+    def __init__(self, rate, burst=0):
+        """
+        rate: number of tokens added per second
+        burst: number of tokens which can be taken in advance
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def acquire(self, cost=1):
+        """
+        Take cost tokens, sleep first until the bucket isn't in debt anymore.
+        Return the time spent waiting.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        delay = 0.0
+        if self.tokens < 0:
+            delay = -self.tokens / self.rate
+            time.sleep(delay)
+            self.tokens = 0
+            self.last = now + delay
+        self.tokens -= cost
+        return delay
+
+
+class FlowControl():
+
+    def __init__(self, rates=None, burst=1):
+        """
+        rates: maximum number of commands per second by opcode class, classes without rate are not limited
+        burst: number of commands of the fastest class sent without waiting
+        """
+        self.rates = {}
+        # Processing time of a command by opcode class
+        self.costs = {}
+        self.burst = burst
+        self.bucket = None
+        for cls, rate in (rates or {}).items():
+            self.set_rate(cls, rate)
+
+    def set_rate(self, cls, rate):
+        if rate:
+            self.rates[cls] = rate
+            self.costs[cls] = 1.0 / rate
+        else:
+            self.rates.pop(cls, None)
+            self.costs.pop(cls, None)
+
+        # Tokens are seconds of processing time of the amp
+        self.bucket = None
+        if self.costs:
+            self.bucket = TokenBucket(1.0, (self.burst - 1) * min(self.costs.values()))
+
+    def wait(self, cmd):
+        """
+        Wait until cmd can be sent.
+        """
+        cost = self.costs.get(opcode_class.get(cmd))
+        if cost:
+            return self.bucket.acquire(cost)
+        return 0.0
+
+
+def device_id(serial_port):
+    """
+    Stable name of the device, the /dev/serial/by-id link of the port if there is one.
+    """
+    by_id = '/dev/serial/by-id'
+    path = os.path.realpath(serial_port)
+    try:
+        for name in os.listdir(by_id):
+            if os.path.realpath(os.path.join(by_id, name)) == path:
+                return os.path.join(by_id, name)
+    except OSError:
+        pass
+    return serial_port
+
+
+def _load_profiles(path):
+    import json
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def load_profile(serial_port, path=PROFILE_PATH):
+    """
+    Return the calibrated rates of a device or None if it wasn't calibrated.
+    """
+    try:
+        profile = _load_profiles(path).get(device_id(serial_port))
+    except (OSError, ValueError) as e:
+        logger.warning("Unable to read the flow control profiles : " + str(e))
+        return None
+    if not profile:
+        return None
+    rates = profile.get('rates') if isinstance(profile, dict) else None
+    if not isinstance(rates, dict):
+        logger.warning("Invalid flow control profile for " + device_id(serial_port) + ", calibrate it again")
+        return None
+    return rates
+
+def _save_profiles(path, profiles):
+    import json
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Readers never see a partially written file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp, path)
+
+def save_profile(serial_port, rates, path=PROFILE_PATH):
+    try:
+        profiles = _load_profiles(path)
+    except ValueError:
+        profiles = {}
+    profiles[device_id(serial_port)] = { 'rates': rates, 'calibrated': time.time() }
+    _save_profiles(path, profiles)
+
+def clear_profile(serial_port, path=PROFILE_PATH):
+    """
+    Remove the calibrated rates of a device.
+    Return False if it wasn't calibrated.
+    """
+    profiles = _load_profiles(path)
+    if profiles.pop(device_id(serial_port), None) is None:
+        return False
+    _save_profiles(path, profiles)
+    return True
+
+
+def _probe_cmds(z906, cls, count):
+    """
+    Commands which don't change the state of the amp once all sent.
+    """
+    if cls == 'level':
+        # Down first if up is a no-op at the maximum
+        if z906.get_level() >= z906.VOLUME_MAX:
+            return [ 0x09, 0x08 ] * (count // 2)
+        return [ 0x08, 0x09 ] * (count // 2)
+    elif cls == 'input':
+        return [ INPUT_CMDS[z906.status[z906.STATUS_CURRENT_INPUT] % len(INPUT_CMDS)] ] * count
+    elif cls == 'query':
+        return [ z906.GET_STATUS ] * count
+    elif cls == 'power':
+        return [ 0x38 if z906.is_muted() else 0x39 ] * count
+    raise ValueError("Unknown opcode class " + cls)
+
+def _probe(z906, cls, count, min_rate, max_rate, margin):
+    cmds = _probe_cmds(z906, cls, count)
+
+    # Stop at the first dropped command, the next ones would all cost a timeout
+    chunk = z906.window * 4
+
+    def sustained(rate):
+        z906.flow.set_rate(cls, rate)
+        start = time.monotonic()
+        acked = 0
+        for i in range(0, len(cmds), chunk):
+            results = z906.request_many(cmds[i:i + chunk])
+            acked += len(results) - results.count(None)
+            if None in results:
+                break
+        logger.info("Probing " + cls + " at {:.0f}/s : {}/{} acked, {:.0f}/s achieved".format(rate, acked, len(cmds), acked / (time.monotonic() - start)))
+        return acked == len(cmds)
+
+    if sustained(max_rate):
+        return None
+
+    # Search on a log scale
+    low, high = min_rate, max_rate
+    while high / low > 1.1:
+        rate = (low * high) ** 0.5
+        if sustained(rate):
+            low = rate
+        else:
+            high = rate
+
+    if low == min_rate and not sustained(min_rate):
+        raise Exception("Commands of class " + cls + " are dropped even at {:.0f}/s".format(min_rate))
+    return round(low * margin, 1)
+
+def _restore(z906, status, tries=3):
+    """
+    Set the levels and the input back to the ones of status, sending the commands one at a time.
+    """
+    for i in range(tries + 1):
+        try:
+            z906.update()
+        except TimeoutError:
+            continue
+        cmds = []
+        for spkr, field in z906.speaker_fields.items():
+            up, down = z906.level_cmds[spkr]
+            diff = status[field] - z906.status[field]
+            cmds += [ up if diff > 0 else down ] * abs(diff)
+        cur_input = status[z906.STATUS_CURRENT_INPUT]
+        if z906.status[z906.STATUS_CURRENT_INPUT] != cur_input:
+            cmds.append(INPUT_CMDS[cur_input % len(INPUT_CMDS)])
+        if not cmds:
+            return True
+        if i < tries:
+            z906.request_many(cmds, window=1)
+    logger.warning("Unable to restore the levels and input of the Z906")
+    return False
+
+def calibrate(z906, classes=OPCODE_CLASSES, count=40, min_rate=5.0, max_rate=2000.0, margin=0.8, timeout=0.25, power_off=False):
+    """
+    Measure the maximum rate of each opcode class for which all the commands are acknowledged.
+    Return the rates to use by class, None when the class doesn't need to be limited.
+
+    The levels and the input are restored after the probes, some probe commands may have been dropped.
+    timeout: serial timeout during the probes, a dropped command costs a timeout
+    power_off: power off the Z906 after probing the power class, the mute probes power it on
+    and the Z906 doesn't report whether it was on before
+    """
+    def run():
+        saved = dict(z906.flow.rates)
+        saved_timeout = z906.ser.timeout
+        z906.update()
+        status = bytes(z906.status)
+        z906.ser.timeout = timeout
+        rates = {}
+        try:
+            for cls in classes:
+                rates[cls] = _probe(z906, cls, count, min_rate, max_rate, margin)
+        finally:
+            z906.ser.timeout = saved_timeout
+            for cls in classes:
+                z906.flow.set_rate(cls, saved.get(cls))
+            _restore(z906, status)
+            if 'power' in classes and power_off:
+                z906.power_off()
+        return rates
+    return z906.submit(run).result()
+
+
+def main(argv=None):
+
+    import argparse
+    import z906client
+    argparser = argparse.ArgumentParser(description="Logitech Z906 flow control")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--port', '-p', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
+    argparser.add_argument('--file', '-f', dest='file', help='Profile file', default=PROFILE_PATH)
+    subparsers = argparser.add_subparsers(dest='mode', required=True)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='Measure the maximum command rates and save them')
+    calibrate_parser.add_argument('--count', '-n', dest='count', help='Number of commands of each probe', default=40, type=int)
+    calibrate_parser.add_argument('--margin', '-m', dest='margin', help='Fraction of the measured rate to use', default=0.8, type=float)
+    calibrate_parser.add_argument('--power-off', dest='power_off', help='Power off the Z906 after the calibration', default=False, action='store_const', const=True)
+
+    subparsers.add_parser('show', help='Show the saved rates')
+    subparsers.add_parser('clear', help='Remove the saved rates')
+    args = argparser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.mode == 'show':
+        rates = load_profile(args.port, args.file)
+        if rates is None:
+            print("No profile for " + device_id(args.port))
+            return
+        for cls in OPCODE_CLASSES:
+            rate = rates.get(cls)
+            print("{:6} : ".format(cls) + ("{:.1f} commands/s".format(rate) if rate else "unlimited"))
+        return
+
+    if args.mode == 'clear':
+        if not clear_profile(args.port, args.file):
+            print("No profile for " + device_id(args.port))
+        return
+
+    z906 = z906client.Z906Client(args.port, flow=False)
+    rates = calibrate(z906, count=args.count, margin=args.margin, power_off=args.power_off)
+    z906.close()
+    save_profile(args.port, rates, args.file)
+    for cls, rate in rates.items():
+        print("{:6} : ".format(cls) + ("{:.1f} commands/s".format(rate) if rate else "unlimited"))
+
+
+if __name__ == '__main__':
+    main()
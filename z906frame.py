@@ -0,0 +1,112 @@
+#! /usr/bin/python3
+
+# Encoding and decoding of the extended frames exchanged with the Z906
+#
+# Frame format : 0xAA <type> <length> <data ...> <checksum>
+# The checksum is computed over the type, length and data bytes.
+
+FRAME_START     = 0xAA
+HEADER_LENGTH   = 3
+OVERHEAD        = HEADER_LENGTH + 1
+MAX_DATA_LENGTH = 0xFF
+
+
+def cksum(frame):
+    """
+    Compute the checksum of a complete frame (including the start and checksum bytes).
+    """
+    return -sum(memoryview(frame)[1:-1]) & 0xFF
+
+
+def frame_length(data_length):
+    """
+    Return the total length of a frame carrying data_length bytes.
+    """
+    return data_length + OVERHEAD
+
+
+def build(req_type, data, buf=None):
+    """
+    Build a frame of type req_type with the provided data.
+
+    buf: optional preallocated bytearray to build the frame into. It must be
+         at least frame_length(len(data)) bytes long.
+
+    Return a memoryview over the built frame.
+    """
+    l = len(data)
+    if l > MAX_DATA_LENGTH:
+        raise ValueError("Frame data too long")
+
+    total = l + OVERHEAD
+    if buf is None:
+        buf = bytearray(total)
+    elif len(buf) < total:
+        raise ValueError("Buffer too small for frame")
+
+    buf[0] = FRAME_START
+    buf[1] = req_type
+    buf[2] = l
+    buf[HEADER_LENGTH:total - 1] = data
+    buf[total - 1] = -(req_type + l + sum(data)) & 0xFF
+    return memoryview(buf)[:total]
+
+
+def is_valid(frame):
+    """
+    Check the start byte, length and checksum of a frame.
+    """
+    l = len(frame)
+    if l < OVERHEAD or frame[0] != FRAME_START or frame[2] + OVERHEAD != l:
+        return False
+    return cksum(frame) == frame[-1]
+
+
+def data(frame):
+    """
+    Return a memoryview over the data of a frame.
+    """
+    return memoryview(frame)[HEADER_LENGTH:-1]
+
+
+def to_hex(frame):
+    """
+    Format a frame or any bytes-like object for logging.
+    """
+    return bytes(frame).hex(' ')
+
+
+class FrameReader():
+    """
+    Read frames from a serial-like object into a preallocated buffer.
+
+    The returned memoryviews are only valid until the next call to read().
+    """
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.buf = bytearray(frame_length(MAX_DATA_LENGTH))
+        self.view = memoryview(self.buf)
+
+    def read_frame(self, first=None):
+        """
+        Read a frame from the serial port.
+
+        first: start byte when it has already been read by the caller
+
+        Return the frame or None on timeout.
+        """
+        pos = 0
+        if first is not None:
+            self.buf[0] = first
+            pos = 1
+
+        # Read the header then the data and checksum
+        pos += self.ser.readinto(self.view[pos:HEADER_LENGTH])
+        if pos < HEADER_LENGTH:
+            return None
+        total = frame_length(self.buf[2])
+        pos += self.ser.readinto(self.view[pos:total])
+        if pos < total:
+            return None
+        return self.view[:total]
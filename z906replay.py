@@ -0,0 +1,498 @@
+#! /usr/bin/python3
+
+# Record, replay and fuzz the serial and CEC traffic of the Z906 clients
+#
+# Traces are text files with one event per line : <timestamp> <direction> <data>
+#   TX    : bytes written to the Z906 (hex)
+#   RX    : bytes read from the Z906 (hex)
+#   DROP  : bytes discarded from the input buffer before a request (hex)
+#   CEC   : CEC command received from libcec (libcec string format)
+#   CECTX : CEC command sent (libcec string format)
+
+import logging
+import random
+import time
+
+import z906frame
+
+SERIAL_DIRECTIONS = ( 'TX', 'RX', 'DROP' )
+
+
+class Recorder():
+
+    def __init__(self, f):
+        """
+        f: path or file object to write the trace to
+        """
+        if isinstance(f, str):
+            f = open(f, 'w')
+        self.f = f
+        self.start = time.monotonic()
+
+    def record(self, direction, data):
+        if not isinstance(data, str):
+            data = bytes(data).hex()
+        self.f.write("{:.6f} {} {}\n".format(time.monotonic() - self.start, direction, data))
+
+    def close(self):
+        self.f.close()
+
+
+class RecordingSerial():
+    """
+    Serial port wrapper recording all the traffic.
+    """
+
+    def __init__(self, ser, recorder):
+        self.ser = ser
+        self.recorder = recorder
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def write(self, data):
+        self.recorder.record('TX', data)
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.recorder.record('RX', data)
+        return data
+
+    def readinto(self, b):
+        n = self.ser.readinto(b)
+        if n:
+            self.recorder.record('RX', b[:n])
+        return n
+
+    def reset_input_buffer(self):
+        # Read the pending bytes to record them before they are discarded
+        pending = self.ser.in_waiting
+        if pending:
+            self.recorder.record('DROP', self.ser.read(pending))
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+
+def attach(z906, recorder):
+    """
+    Record the serial traffic of a Z906Client.
+    """
+    z906.ser = RecordingSerial(z906.ser, recorder)
+    z906.reader.ser = z906.ser
+
+
+def attach_cec(cecClient, recorder):
+    """
+    Record the CEC commands received and sent by a CecClient.
+    """
+    cecClient.recorder = recorder
+
+
+def load(f):
+    """
+    Load a trace and return a list of (timestamp, direction, data).
+    Serial data is returned as bytes and CEC data as strings.
+    """
+    if isinstance(f, str):
+        f = open(f, 'r')
+    events = []
+    with f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            ts, direction, data = line.split(' ', 2)
+            if direction in SERIAL_DIRECTIONS:
+                data = bytes.fromhex(data)
+            events.append((float(ts), direction, data))
+    return events
+
+
+class ReplaySerial():
+    """
+    Serial-like object answering requests with the responses of a trace.
+
+    After each write, the events recorded until the next TX are made available
+    to the reader, including late bytes which were discarded in the live session.
+    """
+
+    def __init__(self, events, speed=0):
+        """
+        speed: replay speed factor relative to the recording, 0 to replay without any delay
+        """
+        self.logger = logging.getLogger("ReplaySerial")
+        self.events = [ e for e in events if e[1] in SERIAL_DIRECTIONS ]
+        self.speed = speed
+        self.pos = 0
+        self.rx = bytearray()
+        self.rx_times = []
+        self.mismatches = 0
+        self._queue_until_tx(time.monotonic(), 0.0)
+
+    def _queue_until_tx(self, now, origin):
+        while self.pos < len(self.events):
+            ts, direction, data = self.events[self.pos]
+            if direction == 'TX':
+                break
+            ready = now
+            if self.speed:
+                ready += (ts - origin) / self.speed
+            self.rx.extend(data)
+            self.rx_times.extend([ ready ] * len(data))
+            self.pos += 1
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        count = 0
+        for t in self.rx_times:
+            if t > now:
+                break
+            count += 1
+        return count
+
+    def write(self, data):
+        data = bytes(data)
+        origin = 0.0
+        if self.pos < len(self.events):
+            ts, direction, expected = self.events[self.pos]
+            origin = ts
+            if expected != data:
+                self.mismatches += 1
+                self.logger.debug("Request mismatch : expected " + z906frame.to_hex(expected) + " got " + z906frame.to_hex(data))
+            self.pos += 1
+        self._queue_until_tx(time.monotonic(), origin)
+        return len(data)
+
+    def read(self, size=1):
+        size = min(size, len(self.rx))
+        if size:
+            delay = self.rx_times[size - 1] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        del self.rx_times[:size]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.read(self.in_waiting)
+
+    def close(self):
+        pass
+
+
+class ReplayStats():
+
+    def __init__(self):
+        self.frames = 0
+        self.errors = 0
+        self.timings = []
+
+    def add(self, duration, error=False):
+        self.frames += 1
+        self.timings.append(duration)
+        if error:
+            self.errors += 1
+
+    def summary(self):
+        if not self.timings:
+            return "no frames"
+        timings = sorted(self.timings)
+        return "{} frames, {} errors, median {:.1f} us, p99 {:.1f} us, max {:.1f} us".format(self.frames, self.errors,
+                timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6, timings[-1] * 1e6)
+
+
+def _pipelined(events, pos):
+    """
+    Return the single byte commands sent from events[pos] until the next
+    extended request or CEC command, the number of commands which were
+    in flight and the position of the next event.
+    """
+    cmds = []
+    window = 0
+    run = 0
+    while pos < len(events):
+        ts, direction, data = events[pos]
+        if direction == 'TX':
+            if len(data) != 1:
+                break
+            cmds.append(data[0])
+            run += 1
+            window = max(window, run)
+        elif direction in SERIAL_DIRECTIONS:
+            run = 0
+        else:
+            break
+        pos += 1
+    return cmds, window, pos
+
+
+def replay(events, z906=None, cecClient=None, speed=0):
+    """
+    Replay a trace through a Z906Client reader and a CecClient command callback.
+
+    The requests recorded in the trace are sent again by the client and answered
+    with the recorded responses. Consecutive single byte commands are sent with
+    request_many() using the window seen in the trace. CEC commands are fed to
+    cecClient._cmdCallback.
+
+    Return a tuple of ReplayStats for serial and CEC.
+    """
+    logger = logging.getLogger("Replay")
+    serial_stats = ReplayStats()
+    cec_stats = ReplayStats()
+
+    ser = ReplaySerial(events, speed)
+    if z906:
+        z906.ser = ser
+        z906.reader.ser = ser
+        if not speed:
+            z906.ack_wait = 0
+
+    start = time.monotonic()
+    pos = 0
+    while pos < len(events):
+        ts, direction, data = events[pos]
+        pos += 1
+        if speed:
+            delay = start + ts / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if direction == 'TX' and z906 and len(data) == 1:
+            cmds, window, pos = _pipelined(events, pos - 1)
+            t = time.perf_counter()
+            try:
+                results = z906.request_many(cmds, window)
+            except Exception as e:
+                logger.debug("Exception while replaying requests " + bytes(cmds).hex() + " : " + repr(e))
+                results = [ None ] * len(cmds)
+            duration = (time.perf_counter() - t) / len(cmds)
+            for ret in results:
+                serial_stats.add(duration, ret is None)
+
+        elif direction == 'TX' and z906:
+            t = time.perf_counter()
+            error = False
+            try:
+                ret = z906.request(data)
+                error = ret is None
+            except Exception as e:
+                logger.debug("Exception while replaying request " + z906frame.to_hex(data) + " : " + repr(e))
+                error = True
+            serial_stats.add(time.perf_counter() - t, error)
+
+        elif direction == 'CEC' and cecClient:
+            t = time.perf_counter()
+            error = False
+            try:
+                cecClient._cmdCallback(data)
+            except Exception as e:
+                logger.debug("Exception while replaying CEC command " + data + " : " + repr(e))
+                error = True
+            cec_stats.add(time.perf_counter() - t, error)
+
+    if ser.mismatches:
+        logger.info(str(ser.mismatches) + " requests did not match the trace")
+
+    return serial_stats, cec_stats
+
+
+def mutate_bytes(data, rnd):
+    """
+    Apply a random mutation to a frame.
+    """
+    data = bytearray(data)
+    op = rnd.randrange(6)
+    if op == 0 and data: # Bit flip
+        i = rnd.randrange(len(data))
+        data[i] ^= 1 << rnd.randrange(8)
+    elif op == 1: # Random byte inserted
+        data.insert(rnd.randrange(len(data) + 1), rnd.randrange(256))
+    elif op == 2 and data: # Byte removed
+        del data[rnd.randrange(len(data))]
+    elif op == 3 and data: # Truncated
+        del data[rnd.randrange(len(data)):]
+    elif op == 4: # Duplicated
+        data.extend(data)
+    else: # Stray bytes before the frame
+        data[0:0] = bytes(rnd.randrange(256) for i in range(rnd.randrange(1, 4)))
+    return bytes(data)
+
+
+def mutate_cec(cmd, rnd):
+    """
+    Apply a random mutation to a CEC command in libcec string format.
+    """
+    prefix = cmd[:3]
+    try:
+        data = bytes.fromhex(cmd[3:].replace(':', ''))
+    except ValueError:
+        data = b''
+    data = mutate_bytes(data, rnd)
+    return prefix + ':'.join('{:02x}'.format(b) for b in data)
+
+
+def fuzz(events, iterations, z906=None, cecClient=None, seed=None):
+    """
+    Replay mutated versions of a trace.
+    Serial responses and CEC commands are mutated, requests are kept intact.
+
+    Return a tuple of ReplayStats for serial and CEC.
+    """
+    rnd = random.Random(seed)
+    serial_stats = ReplayStats()
+    cec_stats = ReplayStats()
+
+    for i in range(iterations):
+        mutated = []
+        for ts, direction, data in events:
+            if direction in ('RX', 'DROP') and rnd.random() < 0.3:
+                data = mutate_bytes(data, rnd)
+            elif direction == 'CEC' and rnd.random() < 0.3:
+                data = mutate_cec(data, rnd)
+            mutated.append((ts, direction, data))
+
+        s, c = replay(mutated, z906, cecClient)
+        for stats, new in ((serial_stats, s), (cec_stats, c)):
+            stats.frames += new.frames
+            stats.errors += new.errors
+            stats.timings.extend(new.timings)
+
+    return serial_stats, cec_stats
+
+
+# CEC commands used for the synthetic trace
+SYNTHETIC_CEC = [ ">> 05:44:41", ">> 05:45", ">> 05:44:42", ">> 05:45", ">> 05:44:43", ">> 05:45",
+        ">> 05:71", ">> 05:7d", ">> 05:8f", ">> 05:70:00:00", ">> 05:9f", ">> 0f:82:10:00",
+        ">> 0f:80:00:00:20:00", ">> 05:c3", ">> 05:c4", ">> 05:a0:00:00:f0", ">> 0f:87:00:e0:91" ]
+
+
+def synthetic_trace():
+    """
+    Generate a trace by running a session against the simulator.
+    """
+    import contextlib
+    import io
+    import z906client
+    import z906sim
+
+    f = io.StringIO()
+    recorder = Recorder(f)
+    z906 = z906client.Z906Client(ser=z906sim.Z906Simulator())
+    z906.ack_wait = 0
+    attach(z906, recorder)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        z906.update()
+        for cmd in [ '+', '+', '-', 'mute on', 'mute off', 'input 2', 'headphones on', 'headphones off', 'fx 3d', 'raw 01 02 03' ]:
+            z906.parse_cmd(cmd)
+        z906.temperature()
+        # Pipelined requests
+        z906.level_step(5)
+        z906.level_step(-3)
+        z906.power_on()
+        z906.update()
+    for cmd in SYNTHETIC_CEC:
+        recorder.record('CEC', cmd)
+
+    f.seek(0)
+    return load(f)
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 traffic recorder, replayer and fuzzer")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    subparsers = argparser.add_subparsers(dest='mode', required=True)
+
+    record_parser = subparsers.add_parser('record', help='Record a live session')
+    record_parser.add_argument('--port', '-p', dest='port', help='Z906 serial port', default=None)
+    record_parser.add_argument('--output', '-o', dest='output', help='Trace file', required=True)
+    record_parser.add_argument('--cec', dest='cec', help='Record a CEC session', default=False, action='store_const', const=True)
+    record_parser.add_argument('--input', '-i', dest='input', help='Z906 input to use with CEC (1-6)', default=1, type=int)
+    record_parser.add_argument('--command', '-c', dest='cmd', help='Execute a single command', action='append', default=None)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay a trace')
+    replay_parser.add_argument('--file', '-f', dest='file', help='Trace file, a synthetic trace is used if not provided', default=None)
+    replay_parser.add_argument('--speed', '-s', dest='speed', help='Speed factor, 0 for no delay', default=0, type=float)
+
+    fuzz_parser = subparsers.add_parser('fuzz', help='Fuzz the clients with a mutated trace')
+    fuzz_parser.add_argument('--file', '-f', dest='file', help='Trace file, a synthetic trace is used if not provided', default=None)
+    fuzz_parser.add_argument('--iterations', '-n', dest='iterations', help='Number of iterations', default=100, type=int)
+    fuzz_parser.add_argument('--seed', dest='seed', help='Random seed', default=None, type=int)
+
+    args = argparser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.mode == 'fuzz':
+        # Errors are expected while fuzzing
+        logging.basicConfig(level=logging.CRITICAL)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    import cecclient
+    import z906client
+
+    if args.mode == 'record':
+        recorder = Recorder(args.output)
+        port = args.port or z906client.SERIAL_PORT
+        try:
+            if args.cec:
+                import z906cec
+                z906cec = z906cec.Z906Cec(port, args.input)
+                attach(z906cec.z906, recorder)
+                attach_cec(z906cec.cecClient, recorder)
+                while True:
+                    time.sleep(1)
+            else:
+                z906 = z906client.Z906Client(port)
+                attach(z906, recorder)
+                z906.update()
+                if args.cmd:
+                    for cmd in args.cmd:
+                        z906.parse_cmd(cmd)
+                else:
+                    z906.main_loop()
+        except KeyboardInterrupt:
+            pass
+        recorder.close()
+        return
+
+    if args.file:
+        events = load(args.file)
+    else:
+        events = synthetic_trace()
+
+    z906 = z906client.Z906Client(ser=ReplaySerial([]))
+    cecClient = cecclient.CecClient("Z906")
+
+    if args.mode == 'replay':
+        serial_stats, cec_stats = replay(events, z906, cecClient, args.speed)
+    else:
+        serial_stats, cec_stats = fuzz(events, args.iterations, z906, cecClient, args.seed)
+
+    print("Serial : " + serial_stats.summary())
+    print("CEC    : " + cec_stats.summary())
+
+    # A trace must replay without errors, this also checks the synthetic trace
+    if args.mode == 'replay' and (serial_stats.errors or cec_stats.errors):
+        return 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#! /usr/bin/python3
+
+# Publication of the Z906 status in a small memory-mapped file
+#
+# Long running clients publish the state of the Z906 after each change so that
+# any number of local readers (status bars, scripts) can read it without any
+# serial traffic. Readers use the sequence counter to get a consistent copy
+# without locking : it's odd while the state is being written.
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+DEFAULT_PATH = '/dev/shm/z906-status' if os.path.isdir('/dev/shm') else '/tmp/z906-status'
+
+MAGIC = b'Z906'
+VERSION = 1
+
+# magic, version, sequence
+HEADER = struct.Struct('<4sBxxxI')
+
+# main, rear, center, sub, input, muted, headphones, effect, temperature, flags, update time
+STATE = struct.Struct('<BBBBBBBBBBxxxxxxd')
+STATE_OFFSET = HEADER.size
+
+SIZE = 64
+
+# Flags
+FLAG_VALID          = 0x01
+FLAG_TEMP_VALID     = 0x02
+
+STATE_FIELDS = ( 'main', 'rear', 'center', 'sub', 'input', 'muted', 'headphones', 'effect' )
+
+
+class StatusPublisher():
+
+    def __init__(self, path=DEFAULT_PATH):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.mm = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        self.seq = 0
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.seq)
+
+    def publish(self, state):
+        """
+        Publish a state as returned by Z906Client.get_state().
+        Can be registered directly as a Z906Client state callback.
+        """
+        flags = 0
+        if state['valid']:
+            flags |= FLAG_VALID
+        temp = state['temperature']
+        if temp is not None:
+            flags |= FLAG_TEMP_VALID
+
+        self.seq += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.seq)
+        STATE.pack_into(self.mm, STATE_OFFSET, state['main'], state['rear'], state['center'], state['sub'], state['input'],
+                int(state['muted']), int(state['headphones']), state['effect'], temp or 0, flags, time.time())
+        self.seq += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+
+class StatusReader():
+
+    # Time in seconds to get a consistent copy before giving up, the writer may have died while updating
+    max_wait = 0.005
+
+    def __init__(self, path=DEFAULT_PATH):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.mm = mmap.mmap(fd, SIZE, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, seq = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError("Invalid status file " + path)
+        self.last = None
+
+    def read(self):
+        """
+        Return a consistent copy of the published state or None if nothing was published yet.
+        When no consistent copy can be read, return the last one read or None.
+        """
+        deadline = None
+        while True:
+            seq = HEADER.unpack_from(self.mm, 0)[2]
+            if not seq & 1:
+                values = STATE.unpack_from(self.mm, STATE_OFFSET)
+                if HEADER.unpack_from(self.mm, 0)[2] == seq:
+                    break
+
+            # Update in progress
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + self.max_wait
+            elif now > deadline:
+                return self.last
+            time.sleep(0)
+
+        if seq == 0:
+            return None
+
+        state = dict(zip(STATE_FIELDS, values))
+        state['muted'] = bool(state['muted'])
+        state['headphones'] = bool(state['headphones'])
+        flags = values[9]
+        state['valid'] = bool(flags & FLAG_VALID)
+        state['temperature'] = values[8] if flags & FLAG_TEMP_VALID else None
+        state['updated'] = values[10]
+        self.last = state
+        return state
+
+    def close(self):
+        self.mm.close()
+
+
+def read_status(path=DEFAULT_PATH):
+    """
+    Read the published state once.
+    """
+    reader = StatusReader(path)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+def publish(z906, path=DEFAULT_PATH):
+    """
+    Publish the state of a Z906Client after each change.
+    """
+    publisher = StatusPublisher(path)
+    publisher.publish(z906.get_state())
+    z906.add_state_callback(publisher.publish)
+    return publisher
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Show the Z906 status published by the long running clients")
+    argparser.add_argument('--file', '-f', dest='file', help='Status file', default=DEFAULT_PATH)
+    argparser.add_argument('--format', '-F', dest='format', help='Output format, fields : ' + ', '.join(STATE_FIELDS) + ', temperature, mute_str', default='{main}/43{mute_str}')
+    argparser.add_argument('--json', '-j', dest='json', help='Output as JSON', default=False, action='store_const', const=True)
+    argparser.add_argument('--watch', '-w', dest='watch', help='Print the status every WATCH seconds', default=None, type=float)
+    args = argparser.parse_args(argv)
+
+    try:
+        reader = StatusReader(args.file)
+    except (OSError, ValueError) as e:
+        print("Z906 status not available : " + str(e))
+        return 1
+
+    while True:
+        state = reader.read()
+        if state is None:
+            print("n/a")
+        elif args.json:
+            import json
+            print(json.dumps(state))
+        else:
+            print(args.format.format(mute_str=' (muted)' if state['muted'] else '', **state))
+
+        if not args.watch:
+            break
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            break
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#! /usr/bin/python3
+
+# Simulated Z906 amplifier behaving like a serial port
+# It can be passed to Z906Client instead of a real serial port for testing and benchmarking.
+
+import logging
+import random
+import time
+from collections import deque
+
+import z906frame
+
+
+class Z906Simulator():
+
+    # Type byte of the responses sent by the simulator
+    STATUS_TYPE         = 0x0A
+    TEMP_TYPE           = 0x0C
+
+    STATUS_DATA_LENGTH  = 20
+    TEMP_DATA_LENGTH    = 6
+
+    # Status fields, see Z906Client
+    STATUS_MAIN_LEVEL       = 3
+    STATUS_REAR_LEVEL       = 4
+    STATUS_CENTER_LEVEL     = 5
+    STATUS_SUB_LEVEL        = 6
+    STATUS_CURRENT_INPUT    = 7
+    STATUS_HEADPHONES       = 20
+
+    # Effect field for each input
+    input_fx_fields = [ 13, 11, 14, 9, 10, 12 ]
+
+    level_cmds = {
+            0x08: (STATUS_MAIN_LEVEL, 1),
+            0x09: (STATUS_MAIN_LEVEL, -1),
+            0x0A: (STATUS_SUB_LEVEL, 1),
+            0x0B: (STATUS_SUB_LEVEL, -1),
+            0x0C: (STATUS_CENTER_LEVEL, 1),
+            0x0D: (STATUS_CENTER_LEVEL, -1),
+            0x0E: (STATUS_REAR_LEVEL, 1),
+            0x0F: (STATUS_REAR_LEVEL, -1) }
+
+    input_cmds = { 0x02: 0, 0x05: 1, 0x03: 2, 0x04: 3, 0x06: 4, 0x07: 5 }
+
+    effect_cmds = { 0x14: 0, 0x15: 1, 0x16: 2, 0x35: 3 }
+
+    def __init__(self, latency=0.0, byte_time=0.0, timeout=5, drop_rate=0.0, max_rate=None, fifo=2):
+        """
+        latency: delay in seconds before the amp starts answering a command
+        byte_time: transmission time of a single byte in seconds
+        drop_rate: probability of a command being ignored by the amp
+        max_rate: number of commands processed per second, the commands received when fifo commands are waiting are dropped
+        """
+        self.logger = logging.getLogger("Z906Simulator")
+        self.latency = latency
+        self.byte_time = byte_time
+        self.timeout = timeout
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self.max_rate = max_rate
+        self.fifo = fifo
+        # End of processing of the commands being processed
+        self.processing = deque()
+
+        self.status = bytearray(self.STATUS_DATA_LENGTH)
+        for field in (self.STATUS_MAIN_LEVEL, self.STATUS_REAR_LEVEL, self.STATUS_CENTER_LEVEL, self.STATUS_SUB_LEVEL):
+            self.status[field - z906frame.HEADER_LENGTH] = 20
+        self.temperature = 40
+        self.powered = False
+        self.muted = False
+        self.commands = 0
+
+        self.txbuf = bytearray()
+        # Pending response bytes as (time available, byte)
+        self.rx = deque()
+        self.last_ready = 0.0
+
+    def get_field(self, field):
+        return self.status[field - z906frame.HEADER_LENGTH]
+
+    def set_field(self, field, val):
+        self.status[field - z906frame.HEADER_LENGTH] = val
+
+    def _queue(self, data, start=None):
+        ready = max((start or time.monotonic()) + self.latency, self.last_ready)
+        for b in data:
+            ready += self.byte_time
+            self.rx.append((ready, b))
+        self.last_ready = ready
+
+    def inject(self, data):
+        """
+        Queue unsolicited bytes as if they were sent by the amp.
+        """
+        self._queue(data)
+
+    def _command(self, cmd):
+        self.commands += 1
+
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+
+        start = None
+        if self.max_rate:
+            # Microcontroller overrun
+            now = time.monotonic()
+            while self.processing and self.processing[0] <= now:
+                self.processing.popleft()
+            if len(self.processing) >= self.fifo:
+                self.dropped += 1
+                return
+            start = max(now, self.processing[-1] if self.processing else now) + 1.0 / self.max_rate
+            self.processing.append(start)
+
+        if cmd == 0x34:
+            self._queue(z906frame.build(self.STATUS_TYPE, self.status), start)
+            return
+        elif cmd == 0x25:
+            data = bytearray(self.TEMP_DATA_LENGTH)
+            data[6 - z906frame.HEADER_LENGTH] = self.temperature
+            self._queue(z906frame.build(self.TEMP_TYPE, data), start)
+            return
+
+        if cmd in self.level_cmds:
+            field, step = self.level_cmds[cmd]
+            val = self.get_field(field) + step
+            if 0 <= val <= 43:
+                self.set_field(field, val)
+        elif cmd in self.input_cmds:
+            self.set_field(self.STATUS_CURRENT_INPUT, self.input_cmds[cmd])
+        elif cmd in self.effect_cmds:
+            self.set_field(self.input_fx_fields[self.get_field(self.STATUS_CURRENT_INPUT)], self.effect_cmds[cmd])
+        elif cmd == 0x10 or cmd == 0x11:
+            self.set_field(self.STATUS_HEADPHONES, 1 if cmd == 0x10 else 0)
+            self.powered = True
+        elif cmd == 0x38 or cmd == 0x39:
+            self.muted = cmd == 0x38
+            self.powered = True
+        elif cmd == 0x37:
+            self.powered = False
+        else:
+            self.logger.debug("Unknown command {:02x}".format(cmd))
+
+        # Commands are acknowledged by echoing them
+        self._queue((cmd,), start)
+
+    def write(self, data):
+        self.txbuf.extend(data)
+        while self.txbuf:
+            if self.txbuf[0] != z906frame.FRAME_START:
+                self._command(self.txbuf.pop(0))
+                continue
+
+            # Extended request, wait for the complete frame
+            if len(self.txbuf) < z906frame.HEADER_LENGTH:
+                break
+            l = z906frame.frame_length(self.txbuf[2])
+            if len(self.txbuf) < l:
+                break
+            frame = bytes(self.txbuf[:l])
+            del self.txbuf[:l]
+            if not z906frame.is_valid(frame):
+                self.logger.debug("Invalid frame received : " + z906frame.to_hex(frame))
+                continue
+            self.commands += 1
+            self._queue((frame[1],))
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        count = 0
+        for ready, b in self.rx:
+            if ready > now:
+                break
+            count += 1
+        return count
+
+    def read(self, size=1):
+        ret = bytearray()
+        deadline = time.monotonic() + self.timeout
+        while len(ret) < size and self.rx:
+            ready, b = self.rx[0]
+            now = time.monotonic()
+            if ready > now:
+                if ready > deadline:
+                    break
+                time.sleep(ready - now)
+            self.rx.popleft()
+            ret.append(b)
+        return bytes(ret)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        now = time.monotonic()
+        while self.rx and self.rx[0][0] <= now:
+            self.rx.popleft()
+
+    def close(self):
+        pass
@@ -0,0 +1,289 @@
+#! /usr/bin/python3
+
+# Temperature and health telemetry of the Z906
+#
+# Samples are stored in a fixed size memory-mapped ring file of binary records
+# which can be queried without loading the whole file.
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import z906client
+import z906shm
+
+MAGIC = b'Z906TLM1'
+
+# magic, record size, capacity, number of records written
+HEADER = struct.Struct('<8sHxxIQ')
+HEADER_SIZE = 32
+
+# timestamp, temperature, main, rear, center, sub, input, spdif, signal, headphones, flags
+RECORD = struct.Struct('<dBBBBBBBBBBxx')
+RECORD_FIELDS = ( 'time', 'temperature', 'main', 'rear', 'center', 'sub', 'input', 'spdif', 'signal', 'headphones', 'flags' )
+
+# Record flags
+FLAG_STATUS_VALID   = 0x01
+FLAG_TEMP_VALID     = 0x02
+FLAG_MUTED          = 0x04
+# Time stepped backward, the timestamp is the one of the previous record
+FLAG_CLOCK_STEP     = 0x08
+
+DEFAULT_CAPACITY = 100000
+
+
+class TelemetryRing():
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, readonly=False):
+        """
+        Open or create a ring file.
+
+        capacity: number of records of a newly created file, ignored for existing files
+        """
+        self.path = path
+        self.readonly = readonly
+
+        if readonly:
+            fd = os.open(path, os.O_RDONLY)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0 and not readonly:
+                os.ftruncate(fd, HEADER_SIZE + capacity * RECORD.size)
+                size = HEADER_SIZE + capacity * RECORD.size
+                self.mm = mmap.mmap(fd, size)
+                HEADER.pack_into(self.mm, 0, MAGIC, RECORD.size, capacity, 0)
+            else:
+                self.mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        magic, record_size, self.capacity, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or record_size != RECORD.size or size < HEADER_SIZE + self.capacity * RECORD.size:
+            self.mm.close()
+            raise ValueError("Invalid telemetry file " + path)
+
+    def close(self):
+        self.mm.close()
+
+    @property
+    def count(self):
+        """
+        Total number of records written since the file was created.
+        """
+        return HEADER.unpack_from(self.mm, 0)[3]
+
+    def append(self, record):
+        """
+        Append a record, overwriting the oldest one when the ring is full.
+
+        record: tuple of values in RECORD_FIELDS order
+
+        The records must stay in time order for the range queries. When the
+        clock steps backward (NTP at boot), the timestamp of the previous
+        record is used until the clock catches up.
+        """
+        count = self.count
+        if count:
+            last = self._get(count - 1)[0]
+            if record[0] < last:
+                record = (last,) + tuple(record[1:-1]) + (record[-1] | FLAG_CLOCK_STEP,)
+        RECORD.pack_into(self.mm, HEADER_SIZE + (count % self.capacity) * RECORD.size, *record)
+        # Publish the record once it's completely written
+        HEADER.pack_into(self.mm, 0, MAGIC, RECORD.size, self.capacity, count + 1)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _first(self, count):
+        return max(0, count - self.capacity)
+
+    def _get(self, num):
+        return RECORD.unpack_from(self.mm, HEADER_SIZE + (num % self.capacity) * RECORD.size)
+
+    def _bisect(self, ts, lo, hi):
+        # Records are appended in time order
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get(mid)[0] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, since=None, until=None):
+        """
+        Iterate over the records between since and until (timestamps).
+        """
+        count = self.count
+        first = self._first(count)
+        if since is not None:
+            first = self._bisect(since, first, count)
+        last = count
+        if until is not None:
+            last = self._bisect(until, first, count)
+        for num in range(first, last):
+            yield self._get(num)
+
+    def query(self, since=None, until=None, step=None):
+        """
+        Return the history between since and until downsampled in buckets of step seconds.
+
+        Each bucket is a dict with the bucket start time, the number of samples,
+        the minimum, average and maximum temperature and the last value of the other fields.
+        """
+        buckets = []
+        bucket = None
+        for rec in self.records(since, until):
+            rec = dict(zip(RECORD_FIELDS, rec))
+            start = rec['time']
+            if step:
+                start -= start % step
+
+            if bucket is None or bucket['time'] != start:
+                bucket = { 'time': start, 'samples': 0, 'temp_min': None, 'temp_max': None, 'temp_sum': 0, 'temp_count': 0 }
+                buckets.append(bucket)
+
+            bucket['samples'] += 1
+            for f in RECORD_FIELDS[2:]:
+                bucket[f] = rec[f]
+            if rec['flags'] & FLAG_TEMP_VALID:
+                temp = rec['temperature']
+                bucket['temp_sum'] += temp
+                bucket['temp_count'] += 1
+                bucket['temp_min'] = temp if bucket['temp_min'] is None else min(bucket['temp_min'], temp)
+                bucket['temp_max'] = temp if bucket['temp_max'] is None else max(bucket['temp_max'], temp)
+
+        for bucket in buckets:
+            count = bucket.pop('temp_count')
+            total = bucket.pop('temp_sum')
+            bucket['temp_avg'] = total / count if count else None
+
+        return buckets
+
+
+class TelemetrySampler():
+    """
+    Periodically sample the Z906 status and temperature into a TelemetryRing.
+
+    Sampling has a lower priority than the user commands : samples are queued
+    after all the pending user requests of the Z906 client.
+    """
+
+    def __init__(self, z906, ring, interval=10.0):
+        self.logger = logging.getLogger("TelemetrySampler")
+        self.z906 = z906
+        self.ring = ring
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="TelemetrySampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        next_sample = time.monotonic()
+        while not self.stopped.is_set():
+            delay = next_sample - time.monotonic()
+            if delay > 0 and self.stopped.wait(delay):
+                break
+
+            try:
+                self.z906.submit(self.sample, priority=self.z906.PRIORITY_LOW).result()
+            except Exception as e:
+                self.logger.warning("Unable to sample telemetry : " + str(e))
+            next_sample += self.interval
+
+    def sample(self):
+        z906 = self.z906
+        flags = 0
+        try:
+            z906.update()
+            flags |= FLAG_STATUS_VALID
+        except TimeoutError:
+            pass
+        temp = z906.temperature()
+        if temp is not None:
+            flags |= FLAG_TEMP_VALID
+        if z906.is_muted():
+            flags |= FLAG_MUTED
+
+        status = z906.status
+        record = ( time.time(), temp or 0,
+                status[z906.STATUS_MAIN_LEVEL], status[z906.STATUS_REAR_LEVEL],
+                status[z906.STATUS_CENTER_LEVEL], status[z906.STATUS_SUB_LEVEL],
+                status[z906.STATUS_CURRENT_INPUT] + 1 if flags & FLAG_STATUS_VALID else 0,
+                status[z906.STATUS_SPDIF_STATUS], status[z906.STATUS_SIGNAL_STATUS],
+                status[z906.STATUS_HEADPHONES], flags )
+        self.ring.append(record)
+        self.logger.debug("Sampled : " + str(record))
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Logitech Z906 telemetry")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--file', '-f', dest='file', help='Telemetry ring file', required=True)
+    subparsers = argparser.add_subparsers(dest='mode', required=True)
+
+    record_parser = subparsers.add_parser('record', help='Sample the Z906 telemetry')
+    record_parser.add_argument('--port', '-p', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
+    record_parser.add_argument('--rate', '-r', dest='rate', help='Sampling interval in seconds', default=10.0, type=float)
+    record_parser.add_argument('--publish', dest='publish', help='Publish the status to this shared memory file', default=None, nargs='?', const=z906shm.DEFAULT_PATH)
+    record_parser.add_argument('--capacity', '-n', dest='capacity', help='Number of records of a new file', default=DEFAULT_CAPACITY, type=int)
+
+    query_parser = subparsers.add_parser('query', help='Show the telemetry history')
+    query_parser.add_argument('--since', '-s', dest='since', help='Show the last SINCE seconds', default=None, type=float)
+    query_parser.add_argument('--step', '-S', dest='step', help='Downsample in buckets of STEP seconds', default=None, type=float)
+
+    args = argparser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.mode == 'record':
+        ring = TelemetryRing(args.file, args.capacity)
+        z906 = z906client.Z906Client(args.port)
+        if args.publish:
+            z906shm.publish(z906, args.publish)
+        sampler = TelemetrySampler(z906, ring, args.rate)
+        sampler.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        sampler.stop()
+        ring.close()
+        return
+
+    ring = TelemetryRing(args.file, readonly=True)
+    since = None
+    if args.since:
+        since = time.time() - args.since
+    for b in ring.query(since, step=args.step):
+        temp = "n/a"
+        if b['temp_avg'] is not None:
+            temp = "{:.1f} C (min {}, max {})".format(b['temp_avg'], b['temp_min'], b['temp_max'])
+        print("{} : {} samples, temperature {}, levels main {}/43 center {}/43 sub {}/43 rear {}/43, input {}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(b['time'])), b['samples'], temp,
+            b['main'], b['center'], b['sub'], b['rear'], b['input']))
+    ring.close()
+
+
+if __name__ == '__main__':
+    main()
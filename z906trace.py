@@ -0,0 +1,196 @@
+#! /usr/bin/python3
+
+# Latency tracing from the CEC or Bluetooth event to the amplifier ack
+#
+# Spans are written in the Chrome trace event format which can be opened
+# as a timeline or flame chart in https://ui.perfetto.dev or chrome://tracing.
+# All the spans caused by the same event share a correlation id, which follows
+# the requests to the Z906Client I/O thread.
+
+import contextvars
+import itertools
+import os
+import threading
+import time
+
+correlation = contextvars.ContextVar('z906trace_correlation', default=None)
+
+tracer = None
+
+
+def now():
+    """
+    Current time in microseconds, as used in the trace.
+    """
+    return time.perf_counter_ns() // 1000
+
+
+class _NullSpan():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+
+class Span():
+
+    def __init__(self, tracer, name, args, root=False):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.root = root
+        self.token = None
+
+    def __enter__(self):
+        if self.root:
+            self.token = correlation.set(next(self.tracer.ids))
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, flow=self.root, **self.args)
+        if self.token:
+            correlation.reset(self.token)
+        return False
+
+
+class Tracer():
+
+    def __init__(self, path):
+        import json
+        self.dumps = json.dumps
+        self.f = open(path, 'w')
+        self.f.write('[\n')
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pid = os.getpid()
+        self.threads = set()
+        self.first = True
+
+    def _write(self, evt):
+        line = self.dumps(evt)
+        with self.lock:
+            if not self.first:
+                self.f.write(',\n')
+            self.first = False
+            self.f.write(line)
+
+    def _thread(self):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self._write({ 'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': { 'name': threading.current_thread().name } })
+        return tid
+
+    def complete(self, name, start, flow=False, **args):
+        """
+        Record a span which started at start (see now()) and ends now.
+        """
+        end = now()
+        tid = self._thread()
+        cid = correlation.get()
+        if cid is not None:
+            args['cid'] = cid
+        self._write({ 'name': name, 'cat': 'z906', 'ph': 'X', 'ts': start, 'dur': end - start, 'pid': self.pid, 'tid': tid, 'args': args })
+        if cid is not None:
+            # Flow events draw arrows between the spans of the same correlation id
+            self._write({ 'name': 'event', 'cat': 'z906', 'ph': 's' if flow else 't', 'id': cid, 'ts': start, 'pid': self.pid, 'tid': tid, 'bp': 'e' })
+
+    def close(self):
+        with self.lock:
+            self.f.write('\n]\n')
+            self.f.close()
+
+
+def enable(path):
+    """
+    Start tracing to the provided file.
+    """
+    global tracer
+    tracer = Tracer(path)
+
+
+def disable():
+    global tracer
+    if tracer:
+        tracer.close()
+    tracer = None
+
+
+def begin(name, **args):
+    """
+    Span starting a new correlation id, to be used when an external event is received.
+    """
+    if not tracer:
+        return _null_span
+    return Span(tracer, name, args, True)
+
+
+def span(name, **args):
+    """
+    Span of a processing stage of the current event.
+    """
+    if not tracer:
+        return _null_span
+    return Span(tracer, name, args)
+
+
+def complete(name, start, **args):
+    """
+    Record a span which started earlier, start being a value returned by now().
+    """
+    if tracer:
+        tracer.complete(name, start, **args)
+
+
+def summary(path):
+    """
+    Return the latency percentiles of each span name and of the events.
+    """
+    import json
+    with open(path) as f:
+        data = f.read().rstrip().rstrip(',')
+    if not data.endswith(']'):
+        # Trace not closed properly
+        data += ']'
+    events = json.loads(data)
+
+    durations = {}
+    totals = {}
+    for evt in events:
+        if evt.get('ph') != 'X':
+            continue
+        durations.setdefault(evt['name'], []).append(evt['dur'])
+        cid = evt['args'].get('cid')
+        if cid is not None:
+            start, end = totals.get(cid, (evt['ts'], evt['ts'] + evt['dur']))
+            totals[cid] = (min(start, evt['ts']), max(end, evt['ts'] + evt['dur']))
+
+    durations['end to end'] = [ end - start for start, end in totals.values() ]
+
+    ret = {}
+    for name, d in durations.items():
+        if not d:
+            continue
+        d.sort()
+        ret[name] = { 'count': len(d), 'p50': d[len(d) // 2], 'p99': d[int(len(d) * 0.99)], 'max': d[-1] }
+    return ret
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Z906 trace summary")
+    argparser.add_argument('file', help='Trace file')
+    args = argparser.parse_args(argv)
+
+    for name, s in summary(args.file).items():
+        print("{:<24} {:6d} spans, p50 {:9.1f} ms, p99 {:9.1f} ms, max {:9.1f} ms".format(name, s['count'], s['p50'] / 1000, s['p99'] / 1000, s['max'] / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#! /usr/bin/python3
+
+# HTTP and WebSocket control API for the Z906
+#
+# GET  /state    : current state as JSON
+# POST /command  : {"cmd": "vol up"}, same commands as z906client.py
+#                  Queries like "status" or "temperature" return {"ok": true, "result": {...}}
+# GET  /ws       : WebSocket, receives {"type": "state", "state": {...}} on connection
+#                  then {"type": "delta", "state": {...}} with the changed fields.
+#                  Commands can be sent as {"cmd": "mute", "id": 1}, the result is
+#                  returned as {"type": "result", "id": 1, "ok": true}.
+#
+# Errors are returned as {"ok": false, "error": "..."}.
+#
+# The Z906 status is polled once per interval whatever the number of clients.
+
+import asyncio
+import json
+import logging
+
+from aiohttp import web, WSMsgType
+
+import z906client
+import z906shm
+
+
+class Z906Web():
+
+    # Commands which print the state in the CLI and the state fields they return, None for all of them
+    queries = {
+            'status': None,
+            'v': ( 'main', 'rear', 'center', 'sub' ),
+            'vol': ( 'main', 'rear', 'center', 'sub' ),
+            'volume': ( 'main', 'rear', 'center', 'sub' ),
+            'i': ( 'input', ),
+            'input': ( 'input', ),
+            'h': ( 'headphones', ),
+            'headphones': ( 'headphones', ),
+            'temperature': ( 'temperature', ) }
+
+    def __init__(self, z906, poll_interval=1.0):
+        self.logger = logging.getLogger("Z906Web")
+        self.z906 = z906
+        self.poll_interval = poll_interval
+        self.state = {}
+        self.clients = set()
+        self.loop = None
+
+        self.app = web.Application()
+        self.app.router.add_get('/state', self._getState)
+        self.app.router.add_post('/command', self._postCommand)
+        self.app.router.add_get('/ws', self._websocket)
+        self.app.on_startup.append(self._startup)
+        self.app.on_cleanup.append(self._cleanup)
+
+        self.z906.add_state_callback(self._stateCallback)
+
+    async def _startup(self, app):
+        self.loop = asyncio.get_running_loop()
+        self.poller = asyncio.ensure_future(self._poll())
+
+    async def _cleanup(self, app):
+        self.poller.cancel()
+        for ws in list(self.clients):
+            await ws.close()
+
+    async def _poll(self):
+        while True:
+            try:
+                await asyncio.wrap_future(self.z906.submit(self.z906.update, priority=self.z906.PRIORITY_LOW))
+            except Exception as e:
+                self.logger.warning("Unable to poll the Z906 : " + repr(e))
+            await asyncio.sleep(self.poll_interval)
+
+    def _stateCallback(self, state):
+        # Called from the I/O thread
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._publish, state)
+
+    def _publish(self, state):
+        delta = { k: v for k, v in state.items() if self.state.get(k) != v }
+        if not delta:
+            return
+        self.state.update(delta)
+        self.logger.debug("State changed : " + str(delta))
+        if self.clients:
+            msg = json.dumps({ 'type': 'delta', 'state': delta })
+            for ws in list(self.clients):
+                asyncio.ensure_future(self._send(ws, msg))
+
+    async def _send(self, ws, msg):
+        try:
+            await ws.send_str(msg)
+        except ConnectionError:
+            self.clients.discard(ws)
+
+    def _query(self, fields):
+        # Called from the I/O thread
+        self.z906.update()
+        if fields is None or 'temperature' in fields:
+            self.z906.temperature()
+        state = self.z906.get_state()
+        if fields is None:
+            return state
+        return { f: state[f] for f in fields }
+
+    async def _command(self, cmd):
+        """
+        Run a command and return a tuple of the result, the error message and the HTTP status.
+        """
+        if not isinstance(cmd, str):
+            return None, "Invalid command", 400
+
+        words = cmd.split()
+        try:
+            if len(words) == 1 and words[0] in self.queries:
+                future = self.z906.submit(self._query, self.queries[words[0]])
+            else:
+                future = self.z906.submit(self.z906.parse_cmd, cmd)
+            return await asyncio.wrap_future(future), None, 200
+        except ValueError as e:
+            return None, str(e), 400
+        except (TimeoutError, OSError) as e:
+            self.logger.warning("Unable to run command " + cmd + " : " + repr(e))
+            return None, "No response from the Z906", 504
+        except Exception as e:
+            self.logger.exception("Error while running command " + cmd)
+            return None, "Internal error : " + repr(e), 500
+
+    async def _getState(self, request):
+        return web.json_response(self.state)
+
+    async def _postCommand(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({ 'ok': False, 'error': "Invalid JSON" }, status=400)
+        if not isinstance(body, dict):
+            return web.json_response({ 'ok': False, 'error': "Invalid request" }, status=400)
+
+        result, error, status = await self._command(body.get('cmd'))
+        if error:
+            return web.json_response({ 'ok': False, 'error': error }, status=status)
+        response = { 'ok': True, 'state': self.state }
+        if result is not None:
+            response['result'] = result
+        return web.json_response(response)
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        # Registered before sending the snapshot so that no change is missed, the deltas are sent after it
+        self.clients.add(ws)
+        self.logger.debug("WebSocket client connected, " + str(len(self.clients)) + " clients")
+
+        try:
+            await ws.send_str(json.dumps({ 'type': 'state', 'state': self.state }))
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    req = json.loads(msg.data)
+                    cmd = req['cmd']
+                except (ValueError, TypeError, KeyError):
+                    await ws.send_str(json.dumps({ 'type': 'result', 'ok': False, 'error': "Invalid request" }))
+                    continue
+
+                ret, error, status = await self._command(cmd)
+                result = { 'type': 'result', 'id': req.get('id'), 'ok': error is None }
+                if error:
+                    result['error'] = error
+                elif ret is not None:
+                    result['result'] = ret
+                await ws.send_str(json.dumps(result))
+        finally:
+            self.clients.discard(ws)
+            self.logger.debug("WebSocket client disconnected, " + str(len(self.clients)) + " clients")
+
+        return ws
+
+    def run(self, host, port):
+        web.run_app(self.app, host=host, port=port, print=None)
+
+
+def main(argv=None):
+
+    import argparse
+    argparser = argparse.ArgumentParser(description="Logitech Z906 HTTP and WebSocket API")
+    argparser.add_argument('--debug', '-d', dest='debug', help='Enable debugging', default=False, action='store_const', const=True)
+    argparser.add_argument('--port', '-p', dest='port', help='Z906 serial port', default=z906client.SERIAL_PORT)
+    argparser.add_argument('--listen', '-l', dest='listen', help='Address to listen on', default='127.0.0.1')
+    argparser.add_argument('--listen-port', '-L', dest='listen_port', help='TCP port to listen on', default=8906, type=int)
+    argparser.add_argument('--interval', '-i', dest='interval', help='Status polling interval in seconds', default=1.0, type=float)
+    argparser.add_argument('--publish', dest='publish', help='Publish the status to this shared memory file', default=None, nargs='?', const=z906shm.DEFAULT_PATH)
+    args = argparser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    z906 = z906client.Z906Client(args.port)
+
+    if args.publish:
+        z906shm.publish(z906, args.publish)
+    server = Z906Web(z906, args.interval)
+    server.run(args.listen, args.listen_port)
+
+
+if __name__ == '__main__':
+    main()